@@ -0,0 +1,547 @@
+#!/usr/bin/python
+"""
+Benchmarks for the hot paths of irc.py.
+Nothing here touches the network.
+
+Run with:
+    python bench.py
+for the hot functions one by one, checked against bench_baseline.json:
+    python bench.py micro [--json results.json] [--save] [--threshold 0.5]
+or, for whole downloads from a local fakeirc.py bot:
+    python bench.py endtoend [thread|asyncio] [zerocopy]
+"""
+
+import sys
+import json
+import socket
+import logging
+import platform
+import resource
+import subprocess
+from argparse import ArgumentParser
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from random import Random
+from os import devnull, chdir
+from os.path import dirname, join, realpath, isfile
+from shutil import rmtree
+from tempfile import mkdtemp
+from re import match, search, sub
+from threading import Thread, Event
+from time import sleep, perf_counter
+
+import irc
+from fakeirc import parseSize
+
+NICK = "roughneck"
+
+# The regular expression string irc.py parsed every message with
+MESSAGE_REGEX = r"(:(?P<prefix>((?P<nickname>[^@!\s]+)((((!(?P<user>\S+))?)@(?P<host>\S+))?))|(\S*)) )?(?P<command>\S+) ((?!:)(?P<params>.+?) )?:(?P<trailing>.+)"
+
+# A mix of the traffic a downloader sees on a busy channel
+SAMPLE_LINES = [
+    ":Bot|01!~iroffer@bots.example.net PRIVMSG #news :** 1723 packs ** 3 of 10 slots open, Record: 7340.1kB/s",
+    ":someone!~user@host-83-12.example.org PRIVMSG #chat :anyone seen the new episode yet?",
+    ":irc.example.net 353 " + NICK + " = #chat :alice bob carol dave eve mallory trent",
+    ":Bot|01!~iroffer@bots.example.net NOTICE " + NICK + " :** Sending you pack #42 (\"[Grp] Show - 01 [720p].mkv\"), which is 350MB. (resume supported)",
+    ":Bot|01!~iroffer@bots.example.net PRIVMSG " + NICK + " :\x01DCC SEND \"[Grp] Show - 01 [720p].mkv\" 3232235777 45000 367001600\x01",
+    "PING :irc.example.net",
+    ":other!~o@example.com JOIN :#chat",
+    ":irc.example.net 372 " + NICK + " :- Welcome to the message of the day, please behave.",
+    ":Bot|02!~iroffer@bots.example.net NOTICE " + NICK + " :  md5sum       0123456789abcdef0123456789abcdef",
+    ":someone!~user@host-83-12.example.org QUIT :Ping timeout: 240 seconds",
+]
+
+
+def oldParse(line, nick = NICK):
+    """The per-line regex work done before the dispatch table existed."""
+    # once in ListenerThread.run ...
+    if not match(MESSAGE_REGEX, line):
+        return
+    # ... and the cascade in IRCParseThread.run
+    regex = match(MESSAGE_REGEX, line)
+    nickname, command, params, trailing = (regex.group(x) for x in ("nickname", "command", "params", "trailing"))
+    search(r"^ERROR :Closing Link:", line)
+    trailing == "Nickname is already in use."
+    if params == nick:
+        search(r"Welcome to the.*" + nick, trailing)
+    if command == "JOIN" and nickname == nick:
+        sub(r"[#]", "", trailing.lower())
+    if command == "PRIVMSG" and params == nick and trailing != "\x01VERSION\x01":
+        search(r"\x01DCC SEND", trailing)
+    if command == "NOTICE" and params == nick:
+        search(r"\*\* You can only have .* at a time, Added you to the main queue for", trailing)
+    search(r":([^!^:]+)![^!]+NOTICE " + nick + r" : md5sum +([a-f0-9]+)", line)
+
+
+def newParse(line, dispatch = dict.fromkeys(("PING", "PRIVMSG", "NOTICE", "JOIN", "001", "433", "ERROR"))):
+    """Parse once and look up the command in the dispatch table."""
+    msg = irc.parseMessage(line)
+    if msg is not None:
+        dispatch.get(msg.command)
+
+
+class QuietConnection:
+    """Just enough of an IRCConnection for a DCCThread to run against."""
+    gui = None
+
+    def __init__(self, chunkSize = 256 * 1024):
+        self.chunkSize = chunkSize
+        self.metrics = irc.Metrics()
+
+    def limiterFor(self, bot):
+        return None
+
+    def lockPrint(self, string):
+        pass
+
+
+def feed(sock, total, block = 1024 * 1024):
+    """Writes total bytes to sock from a separate thread, like a bot would."""
+    def run():
+        data = memoryview(bytes(block))
+        left = total
+        while left > 0:
+            sock.sendall(data[:left])
+            left -= block
+        sock.close()
+    t = Thread(target = run)
+    t.start()
+    return t
+
+
+def oldReceive(sock, f, filesize):
+    """The DCCThread.run receive loop before recv_into."""
+    bytesReceived = 0
+    while bytesReceived != filesize:
+        tmp = sock.recv(4096)
+        bytesReceived += len(tmp)
+        if len(tmp) <= 0:
+            break
+        f.write(tmp)
+
+
+def newReceive(sock, f, filesize):
+    dcc = irc.DCCThread("bench", None, None, filesize, QuietConnection(), "bot")
+    dcc.socket = sock
+    dcc.file = f
+    dcc.receiveLoop()
+
+
+def writerReceive(sock, f, filesize):
+    """receiveLoop handing its buffers to a DiskWriter."""
+    dcc = irc.DCCThread("bench", None, None, filesize, QuietConnection(), "bot")
+    dcc.socket = sock
+    dcc.file = f
+    dcc.writer = irc.DiskWriter(f)
+    dcc.receiveLoop()
+    dcc.flushBuffer()
+    dcc.writer.close()
+
+
+class SlowDisk:
+    """A file that takes as long to write to as a disk doing rate MB/s."""
+    def __init__(self, rate):
+        self.rate = rate
+
+    def write(self, data):
+        # sleeping lets go of the GIL the way a real write does
+        sleep(len(data) / (self.rate * 1e6))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def spliceReceive(sock, f, filesize):
+    dcc = irc.DCCThread("bench", None, None, filesize, QuietConnection(), "bot")
+    dcc.socket = sock
+    dcc.file = f
+    dcc.spliceLoop()
+
+
+def throughput(receive, total = 512 * 1024 * 1024, disk = None):
+    """MB/s pushed through receive over a local socketpair into /dev/null, or disk."""
+    a, b = socket.socketpair()
+    with open(devnull, "wb") as f:
+        start = perf_counter()
+        sender = feed(b, total)
+        receive(a, f if disk is None else disk, total)
+        elapsed = perf_counter() - start
+    sender.join()
+    a.close()
+    return total / elapsed / 1e6
+
+
+def rate(fn, items, seconds = 1.0):
+    """Calls fn on every item repeatedly for about seconds. Returns items/s."""
+    done = 0
+    start = perf_counter()
+    elapsed = 0
+    while elapsed < seconds:
+        for item in items:
+            fn(item)
+        done += len(items)
+        elapsed = perf_counter() - start
+    return done / elapsed
+
+
+def packlist(lines = 50000, seed = 1):
+    """A synthetic iroffer packlist."""
+    rng = Random(seed)
+    out = ["** 8 packs **  1 of 5 slots open", "** Bandwidth Usage ** Current: 0.0kB/s,"]
+    for i in range(1, lines + 1):
+        out.append("#%-5d %3dx [%4s] [Group%d] Show %d - %02d [%s].mkv" % (i, rng.randint(0, 999),
+            "%dM" % rng.randint(100, 999), rng.randint(0, 9), rng.randint(0, 999), rng.randint(1, 26),
+            rng.choice(("480p", "720p", "1080p"))))
+    return out
+
+
+def watchlist(patterns = 300, seed = 2):
+    """Patterns like a user's packs.txt, a few of which match."""
+    rng = Random(seed)
+    return [r"\[Group%d\] Show %d - .*\[%s\]" % (rng.randint(0, 9), rng.randint(0, 2000),
+        rng.choice(("720p", "1080p"))) for i in range(patterns)]
+
+
+def oldMatch(lines, patterns):
+    """PacklistParsingThread.parseFile before Watchlist: every pattern against every line."""
+    hits = 0
+    for series in patterns:
+        for line in lines:
+            try:
+                (pack, dls, size, name) = [t(s) for t,s in zip((str,int,str,str),
+                search(r"(\S+) +(\d+)x \[([^\[^\]]+)\] ([^\"^\n]+)", line).groups())]
+                if not search(series, name):
+                    raise Exception("regex failure")
+                hits += 1
+            except:
+                continue
+    return hits
+
+
+def newMatch(lines, patterns):
+    records = [record for record in map(irc.parsePackLine, lines) if record is not None]
+    return len(irc.Watchlist(patterns).matches(records))
+
+
+def benchWatchlist():
+    lines = packlist()
+    patterns = watchlist()
+    # the old path is linear in the number of patterns, time a slice of them
+    sample = patterns[:10]
+    start = perf_counter()
+    oldMatch(lines, sample)
+    old = (perf_counter() - start) * len(patterns) / len(sample)
+    start = perf_counter()
+    hits = newMatch(lines, patterns)
+    new = perf_counter() - start
+    print("packlist matching (%d lines, %d patterns, %d hits): old %.1f s (from %d patterns), new %.2f s (%.0fx)"
+        % (len(lines), len(patterns), hits, old, len(sample), new, old / new))
+
+
+def quietLogger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def oldLogging(logger, lines):
+    """What the listener and parse threads logged per line: the whole recv buffer and the raw line."""
+    def log(line, data = "".join(l + "\r\n" for l in lines[:4])):
+        logger.info(("total:\"" + data + "\"").encode(irc.encoding, "replace").decode(irc.encoding, "replace"))
+        logger.info(("\"" + line + "\"").encode(irc.encoding, "replace").decode(irc.encoding, "replace"))
+    return log
+
+
+def newLogging(logger):
+    """The raw line at TRACE level, off by default."""
+    def log(line):
+        if logger.isEnabledFor(irc.TRACE):
+            logger.log(irc.TRACE, "\"%s\"", line)
+    return log
+
+
+def benchLogging():
+    lines = SAMPLE_LINES * 100
+    with open(devnull, "w") as f:
+        old = rate(oldLogging(quietLogger("bench.old", logging.StreamHandler(f)), SAMPLE_LINES), lines)
+        new = rate(newLogging(quietLogger("bench.new", QueueHandler(Queue()))), lines)
+        records = Queue()
+        listener = QueueListener(records, logging.StreamHandler(f))
+        listener.start()
+        traced = quietLogger("bench.trace", QueueHandler(records))
+        traced.setLevel(irc.TRACE)
+        enabled = rate(newLogging(traced), lines)
+        listener.stop()
+    print("logging per line: old %.2f us, new %.3f us (%.0fx), new with TRACE on %.2f us"
+        % (1e6 / old, 1e6 / new, new / old, 1e6 / enabled))
+
+
+def oldFrame(chunks):
+    """ListenerThread.run before LineFramer: decode every chunk, re-split the whole buffer."""
+    data = str()
+    count = 0
+    for chunk in chunks:
+        data += str(chunk, encoding = "UTF-8", errors = "ignore")
+        if "\r\n" not in data:
+            continue
+        lines = data.split("\r\n")
+        count += len(lines) - 1
+        data = lines[-1]
+    return count
+
+
+def newFrame(chunks):
+    framer = irc.LineFramer()
+    return sum(len(framer.feed(chunk)) for chunk in chunks)
+
+
+def benchFraming():
+    # a server flooding NAMES replies
+    names = " ".join("user%d" % i for i in range(60))
+    data = "".join(":irc.example.net 353 %s = #chat :%s\r\n" % (NICK, names) for i in range(20000)).encode()
+    old = [data[i:i + 512] for i in range(0, len(data), 512)]
+    new = [data[i:i + 16384] for i in range(0, len(data), 16384)]
+    start = perf_counter()
+    lines = oldFrame(old)
+    oldTime = perf_counter() - start
+    start = perf_counter()
+    assert newFrame(new) == lines
+    newTime = perf_counter() - start
+    print("line framing (%d lines): old %.0f ms in %d recvs, new %.0f ms in %d recvs (%.1fx)"
+        % (lines, oldTime * 1e3, len(old), newTime * 1e3, len(new), oldTime / newTime))
+
+
+def benchParse():
+    lines = SAMPLE_LINES * 100
+    old = rate(oldParse, lines)
+    new = rate(newParse, lines)
+    print("message parsing: old %d lines/s, new %d lines/s (%.1fx)" % (old, new, new / old))
+
+
+def benchReceive():
+    old = throughput(oldReceive)
+    new = throughput(newReceive)
+    print("dcc receive: old %.0f MB/s, new %.0f MB/s (%.1fx)" % (old, new, new / old))
+    if irc.splice is not None:
+        print("dcc receive: splice %.0f MB/s" % throughput(spliceReceive))
+    # the socketpair stands in for a network as fast as the disk
+    disk = SlowDisk(throughput(newReceive))
+    inline = throughput(newReceive, disk = disk)
+    writer = throughput(writerReceive, disk = disk)
+    print("dcc receive to a %.0f MB/s disk: inline %.0f MB/s, DiskWriter %.0f MB/s (%.1fx)"
+        % (disk.rate, inline, writer, writer / inline))
+
+
+def countLines(con, token):
+    """Counts the lines con handles. Returns the count and an Event set on PING :token."""
+    handled = [0]
+    pinged = Event()
+    handle = con.handler.handle
+    def counting(msg):
+        handled[0] += 1
+        if msg.command == "PING" and msg.trailing == token:
+            pinged.set()
+        handle(msg)
+    con.handler.handle = counting
+    return handled, pinged
+
+
+def benchEndToEnd(engine = "thread", zeroCopy = False, packs = 4, size = "256M", chatter = 50000):
+    """
+    Downloads packs from a fakeirc.py bot running in its own process, so
+    only the client is measured. Reports transfer MB/s, time to first byte,
+    the rate irc lines are handled at and the peak memory of this process.
+    """
+    here = dirname(realpath(__file__))
+    server = subprocess.Popen([sys.executable, join(here, "fakeirc.py"), "--packs", str(packs), "--size", size,
+        "--slots", str(packs), "--chatter", str(chatter)], stdout = subprocess.PIPE, universal_newlines = True)
+    workdir = mkdtemp()
+    try:
+        address = server.stdout.readline().split()[-1]
+        # downloads and the file catalog go to the scratch directory
+        chdir(workdir)
+        # the fake server has no flood limit, let every request out at once
+        con = irc.IRCConnection(address, NICK, engine = engine, zeroCopy = zeroCopy,
+            maxTransfers = packs, botTransfers = packs, floodBurst = packs + 10)
+        handled, pinged = countLines(con, "chatter")
+        start = perf_counter()
+        con.join("bench")
+        pinged.wait(120)
+        parseRate = handled[0] / (perf_counter() - start)
+        parser = con.parseBot("Bot", [r"\.bin"], blocking = False)
+        parser.join()
+        jobs = [job for job in parser.jobs if job.ok]
+    finally:
+        chdir(here)
+        rmtree(workdir)
+        server.terminate()
+    if not jobs:
+        print("end to end (%s): no pack was downloaded" % engine)
+        return
+    total = sum(parseSize(size) for job in jobs)
+    elapsed = max(job.finished for job in jobs) - min(job.requested for job in jobs)
+    ttfb = sum(job.firstByte - job.requested for job in jobs) / len(jobs)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("end to end (%s%s): %d x %s at %.0f MB/s, time to first byte %.0f ms, %d lines/s handled, peak memory %.0f MiB"
+        % (engine, ", zero copy" if zeroCopy else "", len(jobs), size, total / elapsed / 1e6, ttfb * 1e3, parseRate, peak))
+
+
+def microParse():
+    return newParse, SAMPLE_LINES * 10
+
+
+def microDCCSend():
+    texts = [line.split(" :", 1)[1] for line in SAMPLE_LINES if "DCC SEND" in line]
+    texts += ["\x01DCC SEND Show_-_02.mkv 3232235777 45001 367001600\x01", "\x01DCC SEND \"a b.txt\" :3232235777 45002 4096\x01"]
+    return irc.parseDCCSend, texts
+
+
+def microPacklist():
+    """parseFile's work per packlist line: parse the line, match it against 300 patterns."""
+    lines = packlist(5000)
+    patterns = irc.Watchlist(watchlist())
+    def match(lines):
+        patterns.matches([record for record in map(irc.parsePackLine, lines) if record is not None])
+    return match, [lines]
+
+
+def microConvertSize():
+    return irc.convertSize, [0, 512, 1024, 1536000, 367001600, 4 * 1024**3, 3 * 1024**4]
+
+
+def microRateLimiter():
+    """Charging a received chunk through a global -> bot -> transfer hierarchy that never has to wait."""
+    limiter = irc.RateLimiter(10**9, irc.RateLimiter(10**9, irc.RateLimiter(10**9)))
+    return limiter.reserve, [256 * 1024] * 10
+
+
+def microLineFramer():
+    framer = irc.LineFramer()
+    data = "".join(line + "\r\n" for line in SAMPLE_LINES).encode()
+    return framer.feed, [data[i:i + 700] for i in range(0, len(data), 700)]
+
+
+def microCalibration():
+    """Plain interpreter work, timed along the benchmarks to tell how fast the machine is right now."""
+    def work(n):
+        counts = dict()
+        for i in range(n):
+            key = "k%d" % (i & 15)
+            counts[key] = counts.get(key, 0) + i
+        return counts
+    return work, [100] * 10
+
+
+# name -> setup returning (function, items); results are per call of function
+MICRO_BENCHMARKS = {
+    "parse_message": microParse,
+    "parse_dcc_send": microDCCSend,
+    "packlist_match": microPacklist,
+    "convert_size": microConvertSize,
+    "rate_limiter": microRateLimiter,
+    "line_framer": microLineFramer,
+}
+
+
+def runMicro(names = None, rounds = 9, seconds = 0.2):
+    """
+    Nanoseconds per call of each benchmark, the best of rounds runs.
+    The rounds go over all benchmarks in turn, so a slow spell of the
+    machine hits each of them once instead of all runs of one.
+    The results include the calibration workload.
+    """
+    names = list(names or sorted(MICRO_BENCHMARKS)) + ["calibration"]
+    setups = dict((name, MICRO_BENCHMARKS.get(name, microCalibration)()) for name in names)
+    results = dict()
+    for i in range(rounds):
+        for name in names:
+            fn, items = setups[name]
+            ns = 1e9 / rate(fn, items, seconds)
+            results[name] = min(ns, results.get(name, ns))
+    return results
+
+
+def changes(results, baseline):
+    """
+    How much slower each benchmark got than baseline, 0.25 is 25%. When both
+    timed the calibration workload the baseline is scaled by it first, so a
+    machine that is busier or slower overall doesn't count as a regression.
+    """
+    scale = 1.0
+    if "calibration" in results and "calibration" in baseline:
+        scale = results["calibration"] / baseline["calibration"]
+    return dict((name, ns / (baseline[name] * scale) - 1) for name, ns in results.items()
+        if name in baseline and name != "calibration")
+
+
+def compareResults(results, baseline, threshold):
+    """The benchmarks that got slower than baseline by more than threshold (0.25 is 25%)."""
+    return sorted(name for name, change in changes(results, baseline).items() if change > threshold)
+
+
+def benchMicro(args, retries = 2):
+    results = runMicro(args.names)
+    baseline = dict()
+    if isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressed = compareResults(results, baseline, args.threshold)
+    # a regression has to show up again, not just in one noisy run
+    for i in range(retries):
+        if not regressed:
+            break
+        rerun = runMicro(regressed)
+        # in terms of the first run's calibration, the machine may have sped up since
+        scale = results["calibration"] / rerun["calibration"]
+        for name in regressed:
+            results[name] = min(results[name], rerun[name] * scale)
+        regressed = compareResults(results, baseline, args.threshold)
+    changed = changes(results, baseline)
+    for name, ns in sorted(results.items()):
+        change = ""
+        if name in changed:
+            change = "%+6.1f%%" % (changed[name] * 100)
+        print("%-16s %12.1f ns  %s%s" % (name, ns, change, "  REGRESSED" if name in regressed else ""))
+    output = {"python": platform.python_version(), "machine": platform.machine(), "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent = 2, sort_keys = True)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent = 2, sort_keys = True)
+        return 0
+    return 1 if regressed else 0
+
+
+def main(argv):
+    parser = ArgumentParser(description = "Benchmarks for irc.py.")
+    commands = parser.add_subparsers(dest = "command")
+    micro = commands.add_parser("micro", help = "time the hot functions and compare them against a baseline")
+    micro.add_argument("names", nargs = "*", help = "benchmarks to run, all by default")
+    micro.add_argument("--json", help = "write the results to this file")
+    micro.add_argument("--baseline", default = join(dirname(realpath(__file__)), "bench_baseline.json"))
+    micro.add_argument("--threshold", type = float, default = 0.5, help = "allowed slowdown, 0.5 is 50%%")
+    micro.add_argument("--save", action = "store_true", help = "store the results as the new baseline")
+    endtoend = commands.add_parser("endtoend", help = "download packs from a local fakeirc.py bot")
+    endtoend.add_argument("engine", nargs = "?", default = "thread", choices = ("thread", "asyncio"))
+    endtoend.add_argument("zerocopy", nargs = "?", choices = ("zerocopy",))
+    args = parser.parse_args(argv)
+    if args.command == "micro":
+        return benchMicro(args)
+    if args.command == "endtoend":
+        benchEndToEnd(args.engine, args.zerocopy is not None)
+        return 0
+    benchParse()
+    benchFraming()
+    benchReceive()
+    benchWatchlist()
+    benchLogging()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,421 @@
+#!/usr/bin/python
+"""
+A local stand-in for an irc network with iroffer-style XDCC bots,
+so the client can be benchmarked and tested without the internet.
+
+    server = FakeIRCServer()
+    server.addBot(FakeBot("Bot", [FakePack("[Grp] Show - 01 [720p].mkv", 350 * 1024**2)], rate = 5000))
+    server.start()
+    con = irc.IRCConnection(server.address(), "roughneck")
+
+Run it as a script to serve bots from a separate process:
+    python fakeirc.py --packs 4 --size 64M
+"""
+
+import socket
+import logging
+from argparse import ArgumentParser
+from hashlib import md5
+from select import select
+from struct import unpack
+from threading import Thread, Lock, Semaphore
+from math import ceil
+from time import time, sleep
+from zlib import crc32
+
+
+def packlistSize(size):
+    """A size the way iroffer prints it in a packlist."""
+    for unit, scale in (("G", 1024**3), ("M", 1024**2), ("K", 1024)):
+        if size >= scale:
+            if size < 10 * scale:
+                return "%.1f%s" % (size / scale, unit)
+            return "%d%s" % (size // scale, unit)
+    return "%d" % size
+
+
+def parseSize(text):
+    """"64M" -> 67108864"""
+    scale = {"K": 1024, "M": 1024**2, "G": 1024**3}.get(text[-1:].upper(), 1)
+    return int(float(text.rstrip("KMGkmg")) * scale)
+
+
+class FakePack:
+    """
+    A pack of size bytes. Unless data is given the contents are a
+    pattern made from the name, generated on the fly, so a huge pack
+    costs no memory.
+    """
+    BLOCK = 256 * 1024
+
+    def __init__(self, name, size = None, data = None):
+        self.name = name
+        self.data = data
+        self.size = len(data) if data is not None else size
+        pattern = md5(name.encode()).digest()
+        # one pattern longer than a block, so a chunk can start at any offset
+        self.block = memoryview(pattern * (self.BLOCK // len(pattern) + 1))
+        self.sums = None
+
+    def chunks(self, offset = 0, end = None):
+        """The contents from offset to end, at most BLOCK bytes at a time."""
+        end = self.size if end is None else min(end, self.size)
+        while offset < end:
+            n = min(self.BLOCK, end - offset)
+            if self.data is not None:
+                yield memoryview(self.data)[offset:offset + n]
+            else:
+                start = offset % 16
+                yield self.block[start:start + n]
+            offset += n
+
+    def contents(self):
+        return b"".join(self.chunks())
+
+    def hashes(self):
+        """The md5sum and crc32 XDCC INFO reports."""
+        if self.sums is None:
+            digest = md5()
+            crc = 0
+            for chunk in self.chunks():
+                digest.update(chunk)
+                crc = crc32(chunk, crc)
+            self.sums = (digest.hexdigest(), "%08X" % crc)
+        return self.sums
+
+
+class FakeBot:
+    """
+    An iroffer-style XDCC bot. Pack #1 is its packlist, the packs follow.
+    rate: KiB/s of each transfer, 0 for as fast as possible.
+    slots: Transfers at once, later requests wait in a queue,
+        which XDCC QUEUE reports on and XDCC REMOVE leaves.
+    delay: Seconds between a request and the DCC SEND offer.
+    dropAfter: Cut each transfer off after this many bytes,
+        drops times per pack, so the client has to resume.
+    stallAfter: Stop sending after this many bytes and hold the connection
+        open until the client gives up, stalls times per pack.
+    batch: Understand XDCC BATCH 2-4,7, an older bot ignores it.
+    """
+    def __init__(self, nick, packs, rate = 0, slots = 2, delay = 0, dropAfter = None, drops = 1, stallAfter = None, stalls = 1,
+            batch = True):
+        self.nick = nick
+        self.packs = packs
+        self.rate = rate
+        self.slotCount = slots
+        self.slots = Semaphore(slots)
+        self.delay = delay
+        self.dropAfter = dropAfter
+        self.drops = drops
+        self.dropped = dict()
+        self.stallAfter = stallAfter
+        self.stalls = stalls
+        self.stalled = dict()
+        # port -> offset a DCC RESUME asked for
+        self.offsets = dict()
+        # [client, pack, removed] of each queued request, in order
+        self.queue = []
+        self.removed = 0
+        self.batch = batch
+        self.batches = 0
+        self.cancels = 0
+        self.lock = Lock()
+
+    def packlist(self):
+        lines = ["** %d packs **  %d slots" % (len(self.packs), self.slotCount)]
+        for i, pack in enumerate(self.packs):
+            lines.append("#%-3d %3dx [%4s] %s" % (i + 2, 0, packlistSize(pack.size), pack.name))
+        return FakePack(self.nick + ".txt", data = ("\n".join(lines) + "\n").encode())
+
+    def pack(self, number):
+        if number == 1:
+            return self.packlist()
+        if 2 <= number < len(self.packs) + 2:
+            return self.packs[number - 2]
+        return None
+
+    def onMessage(self, client, text):
+        words = text.strip("\x01").split()
+        if len(words) < 2:
+            return
+        command = (words[0] + " " + words[1]).upper()
+        if command in ("XDCC SEND", "XDCC GET") and len(words) > 2:
+            self.request(client, words[2])
+        elif command == "XDCC BATCH" and len(words) > 2 and self.batch:
+            self.batches += 1
+            for number in self.ranges(words[2]):
+                self.request(client, str(number))
+        elif command == "XDCC INFO" and len(words) > 2:
+            self.info(client, words[2])
+        elif command == "XDCC CANCEL":
+            self.cancels += 1
+            client.notice(self.nick, "don't have a transfer")
+        elif command == "XDCC QUEUE":
+            self.queueStatus(client)
+        elif command == "XDCC REMOVE":
+            self.remove(client, self.pack(self.number(words[2])) if len(words) > 2 else None)
+        elif command == "DCC RESUME" and len(words) > 4:
+            port, position = int(words[-2]), int(words[-1])
+            with self.lock:
+                self.offsets[port] = position
+            client.privmsg(self.nick, "\x01DCC ACCEPT %s %d %d\x01" % (" ".join(words[2:-2]), port, position))
+
+    def number(self, text):
+        try:
+            return int(text.lstrip("#"))
+        except ValueError:
+            return None
+
+    def ranges(self, text):
+        """The pack numbers of "2-4,7"."""
+        numbers = []
+        for part in text.split(","):
+            first, _, last = part.partition("-")
+            try:
+                numbers.extend(range(int(first), int(last or first) + 1))
+            except ValueError:
+                pass
+        return numbers
+
+    def request(self, client, text):
+        pack = self.pack(self.number(text))
+        if pack is None:
+            client.notice(self.nick, "** Invalid Pack Number, Try Again")
+            return
+        sender = Thread(target = self.send, args = (client, pack))
+        sender.daemon = True
+        sender.start()
+
+    def info(self, client, text):
+        pack = self.pack(self.number(text))
+        if pack is None:
+            client.notice(self.nick, "** Invalid Pack Number, Try Again")
+            return
+        md5sum, crc = pack.hashes()
+        for key, value in (("Filename", pack.name), ("Sendname", pack.name), ("Filesize", str(pack.size)),
+                ("md5sum", md5sum), ("crc32", crc)):
+            client.notice(self.nick, " %-14s %s" % (key, value))
+
+    def queueStatus(self, client):
+        with self.lock:
+            entries = [(i + 1, entry[1]) for i, entry in enumerate(self.queue) if entry[0] is client]
+            total = len(self.queue)
+        for position, pack in entries:
+            # iroffer's estimate: the queue ahead at the bot's rate, in whole minutes
+            minutes = ceil(position * pack.size / (self.rate * 1024) / 60) if self.rate else 0
+            client.notice(self.nick, "Queued 0h0m for \"%s\", in position %d of %d. %dh%dm or more remaining."
+                % (pack.name, position, total, minutes // 60, minutes % 60))
+
+    def remove(self, client, pack):
+        with self.lock:
+            entries = [entry for entry in self.queue if entry[0] is client and pack in (None, entry[1])]
+            for entry in entries:
+                entry[2] = True
+                self.queue.remove(entry)
+                self.removed += 1
+        for entry in entries:
+            client.notice(self.nick, "Removed you from the queue for \"%s\"" % entry[1].name)
+
+    def send(self, client, pack):
+        if not self.slots.acquire(blocking = False):
+            entry = [client, pack, False]
+            with self.lock:
+                self.queue.append(entry)
+                position = len(self.queue)
+            client.notice(self.nick, "** All Slots Full, Added you to the main queue for pack (\"%s\") in position %d."
+                % (pack.name, position))
+            while not self.slots.acquire(timeout = 0.1):
+                if entry[2]:
+                    return
+            with self.lock:
+                if entry[2]:
+                    self.slots.release()
+                    return
+                self.queue.remove(entry)
+        try:
+            sleep(self.delay)
+            self.serve(client, pack)
+        except OSError as e:
+            logging.info("%s: transfer of %s failed: %s", self.nick, pack.name, e)
+        finally:
+            self.slots.release()
+
+    def serve(self, client, pack):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind((client.server.host, 0))
+        listener.listen(1)
+        listener.settimeout(60)
+        port = listener.getsockname()[1]
+        ip = unpack("!I", socket.inet_aton(client.server.host))[0]
+        name = "\"" + pack.name + "\"" if " " in pack.name else pack.name
+        client.privmsg(self.nick, "\x01DCC SEND %s %d %d %d\x01" % (name, ip, port, pack.size))
+        try:
+            conn, _ = listener.accept()
+        finally:
+            listener.close()
+        with self.lock:
+            offset = self.offsets.pop(port, 0)
+            end = None
+            if self.dropAfter is not None and self.dropped.get(pack.name, 0) < self.drops:
+                self.dropped[pack.name] = self.dropped.get(pack.name, 0) + 1
+                end = offset + self.dropAfter
+            stall = False
+            if self.stallAfter is not None and self.stalled.get(pack.name, 0) < self.stalls:
+                self.stalled[pack.name] = self.stalled.get(pack.name, 0) + 1
+                end = offset + self.stallAfter
+                stall = True
+        started = time()
+        sent = 0
+        try:
+            for chunk in pack.chunks(offset, end):
+                conn.sendall(chunk)
+                sent += len(chunk)
+                if self.rate:
+                    ahead = sent / (self.rate * 1024) - (time() - started)
+                    # the client never sends anything, readable means it hung up
+                    if ahead > 0 and select([conn], [], [], ahead)[0]:
+                        return
+            if stall:
+                select([conn], [], [], 300)
+        finally:
+            conn.close()
+
+
+class FakeClient(Thread):
+    """One connection to a FakeIRCServer."""
+    def __init__(self, server, sock):
+        Thread.__init__(self)
+        self.server = server
+        self.socket = sock
+        self.nick = None
+        self.lock = Lock()
+        self.daemon = True
+
+    def run(self):
+        try:
+            for raw in self.socket.makefile("rb"):
+                self.handle(raw.decode("UTF-8", "replace").rstrip("\r\n"))
+        except OSError:
+            pass
+        finally:
+            self.server.disconnected(self)
+            self.socket.close()
+
+    def send(self, line):
+        with self.lock:
+            self.socket.sendall((line + "\r\n").encode("UTF-8"))
+
+    def privmsg(self, sender, text):
+        self.send(":%s!iroffer@%s PRIVMSG %s :%s" % (sender, self.server.name, self.nick, text))
+
+    def notice(self, sender, text):
+        self.send(":%s!iroffer@%s NOTICE %s :%s" % (sender, self.server.name, self.nick, text))
+
+    def handle(self, line):
+        command, _, rest = line.partition(" ")
+        command = command.upper()
+        if command == "NICK":
+            if not self.server.register(self, rest.strip()):
+                self.send(":%s 433 * %s :Nickname is already in use." % (self.server.name, rest.strip()))
+        elif command == "USER":
+            self.send(":%s 001 %s :Welcome to the FakeNet IRC Network %s" % (self.server.name, self.nick, self.nick))
+        elif command == "PING":
+            self.send(":%s PONG %s %s" % (self.server.name, self.server.name, rest))
+        elif command == "JOIN":
+            self.send(":%s!%s@fake JOIN :%s" % (self.nick, self.nick, rest.strip()))
+            self.server.joined(self, rest.strip())
+        elif command in ("PRIVMSG", "NOTICE"):
+            target, _, text = rest.partition(" :")
+            bot = self.server.bots.get(target.strip())
+            if bot is not None:
+                bot.onMessage(self, text)
+        elif command == "QUIT":
+            self.socket.shutdown(socket.SHUT_RDWR)
+
+
+class FakeIRCServer(Thread):
+    """
+    An irc server that knows just enough for IRCConnection:
+    registration, PING, JOIN and messages to its FakeBots.
+    chatter: Lines of channel traffic sent to a client after it joins, followed
+        by a PING :chatter, so the client's parse rate can be measured.
+    """
+    def __init__(self, host = "127.0.0.1", port = 0, name = "irc.fake.net", chatter = 0):
+        Thread.__init__(self)
+        self.host = host
+        self.name = name
+        self.chatter = chatter
+        self.bots = dict()
+        self.clients = dict()
+        self.lock = Lock()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.daemon = True
+
+    def address(self):
+        return "%s:%d" % self.listener.getsockname()
+
+    def addBot(self, bot):
+        self.bots[bot.nick] = bot
+        return bot
+
+    def run(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            FakeClient(self, sock).start()
+
+    def stop(self):
+        self.listener.close()
+
+    def register(self, client, nick):
+        with self.lock:
+            if nick in self.clients or nick in self.bots:
+                return False
+            self.clients.pop(client.nick, None)
+            self.clients[nick] = client
+            client.nick = nick
+            return True
+
+    def disconnected(self, client):
+        with self.lock:
+            if self.clients.get(client.nick) is client:
+                del self.clients[client.nick]
+
+    def joined(self, client, channel):
+        if not self.chatter:
+            return
+        line = ":someone!~user@chatter.example.org PRIVMSG %s :anyone seen the new episode yet? %%d" % channel
+        for i in range(self.chatter):
+            client.send(line % i)
+        client.send("PING :chatter")
+
+
+def main():
+    parser = ArgumentParser(description = "A fake irc server with an XDCC bot.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 0)
+    parser.add_argument("--bot", default = "Bot")
+    parser.add_argument("--packs", type = int, default = 4, help = "number of packs")
+    parser.add_argument("--size", default = "64M", help = "size of each pack, e.g. 700M")
+    parser.add_argument("--rate", type = int, default = 0, help = "KiB/s per transfer, 0 for unlimited")
+    parser.add_argument("--slots", type = int, default = 2)
+    parser.add_argument("--delay", type = float, default = 0)
+    parser.add_argument("--drop-after", default = None, help = "cut each transfer off once after this many bytes")
+    parser.add_argument("--chatter", type = int, default = 0, help = "lines of channel traffic sent after a JOIN")
+    args = parser.parse_args()
+    packs = [FakePack("[Fake] Pack %02d.bin" % i, parseSize(args.size)) for i in range(1, args.packs + 1)]
+    server = FakeIRCServer(args.host, args.port, chatter = args.chatter)
+    server.addBot(FakeBot(args.bot, packs, rate = args.rate, slots = args.slots, delay = args.delay,
+        dropAfter = parseSize(args.drop_after) if args.drop_after else None))
+    server.start()
+    print("listening on " + server.address(), flush = True)
+    server.join()
+
+
+if __name__ == "__main__":
+    main()
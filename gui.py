@@ -3,12 +3,28 @@ yellowBG = blueBG = cyanText = greenText = yellowText = magentaText = redText =
 
 import curses
 from curses import wrapper
+from collections import deque
+from itertools import islice
+from queue import Queue, Empty
 from threading import Thread, Event
+from time import monotonic
 
 class IRCWindow(Thread):
-    def __init__(self, event):
+    """
+    An IRCWindow owns the terminal. Other threads never touch curses,
+    addLine, clearInput and addInput only queue an update that the
+    window's own thread applies, at most fps redraws a second.
+    scrollback: Rows of history kept, the oldest are dropped first.
+    """
+    def __init__(self, event, scrollback = 1000, fps = 10):
         Thread.__init__(self)
         self.event = event
+        self.updates = Queue()
+        # the scrollback as rows of (text, style) pieces, already wrapped to the window width
+        self.rows = deque([[]], maxlen = scrollback)
+        self.rowLength = 0
+        self.input = []
+        self.frame = 1.0 / fps
 
     def run(self):
         wrapper(self.main)
@@ -18,32 +34,60 @@ class IRCWindow(Thread):
         return string + " " * (self.width - 1 - len(string))
 
     def addLine(self, string, style = 0):
-        if style is None:
-            style = 0
-        self.scroll.addstr(string, style)
-        self.scrollPosMax = self.scroll.getyx()[0] - (self.height - 4)
-        if self.scrollPosMax < 0:
-            self.scrollPosMax = 0
-        self.scrollPos = self.scrollPosMax
-        self.refresh()
+        self.updates.put((self.appendText, string, style))
 
     def clearInput(self):
-        self.inputLine.addstr(0, 0, self.pad(" "), 0)
-        self.refresh()
+        self.updates.put((self.setInput, "", 0, True, False))
 
     def addInput(self, string, style = 0, begin = False, pad = False):
-        if pad:
-            string += " " * (self.width - 1 - self.inputLine.getyx()[1] - len(string))
+        self.updates.put((self.setInput, string, style, begin, pad))
+
+    def appendText(self, string, style):
+        """Adds string to the scrollback, wrapping it at the window width."""
+        if style is None:
+            style = 0
+        lines = string.split("\n")
+        for i, line in enumerate(lines):
+            if i > 0:
+                self.rows.append([])
+                self.rowLength = 0
+            while line:
+                room = self.width - 1 - self.rowLength
+                if room <= 0:
+                    self.rows.append([])
+                    self.rowLength = 0
+                    continue
+                self.rows[-1].append((line[:room], style))
+                self.rowLength += len(line[:room])
+                line = line[room:]
+        # new output scrolls to the bottom
+        self.scrollPosMax = max(0, len(self.rows) - self.viewHeight)
+        self.scrollPos = self.scrollPosMax
+
+    def setInput(self, string, style, begin, pad):
         if begin:
-            self.inputLine.addstr(0, 0, string, style)
-        else:
-            self.inputLine.addstr(string, style)
-        self.refresh()
+            self.input = []
+        length = sum(len(text) for text, _ in self.input)
+        if pad:
+            string += " " * (self.width - 1 - length - len(string))
+        self.input.append((string[:max(0, self.width - 1 - length)], style))
+
+    def applyUpdates(self):
+        """Applies the queued updates. Returns whether there were any."""
+        updated = False
+        while True:
+            try:
+                update = self.updates.get_nowait()
+            except Empty:
+                return updated
+            update[0](*update[1:])
+            updated = True
 
     def main(self, stdscr):
-        self.stdscr = stdscr; self.scrollPosMax = int(-1)
-        self.scrollPos = int(0); self.maxScroll = 100
+        self.stdscr = stdscr; self.scrollPosMax = int(0)
+        self.scrollPos = int(0)
         self.height, self.width = stdscr.getmaxyx()
+        self.viewHeight = self.height - 3
 
         stdscr.clear()
         stdscr.refresh()
@@ -71,10 +115,7 @@ class IRCWindow(Thread):
         curses.mouseinterval(0)
         curses.mousemask(curses.BUTTON4_PRESSED | curses.BUTTON2_PRESSED)
         
-        self.scroll = curses.newpad(self.maxScroll, self.width)
-        self.scroll.scrollok(True)
-        self.scroll.idlok(True)
-        self.scroll.keypad(True)
+        self.scroll = curses.newpad(self.viewHeight + 1, self.width)
 
         self.topLine = stdscr.subwin(1, self.width, 0, 0)
         self.infoLine = stdscr.subwin(1, self.width, self.height - 2, 0)
@@ -83,8 +124,12 @@ class IRCWindow(Thread):
         self.getInput()
 
     def getInput(self):
+        # getch gives up after a frame so queued updates are drawn without a key press
+        self.inputLine.timeout(int(self.frame * 1000))
+        self.inputLine.keypad(True)
+        lastDraw = 0
+        dirty = True
         while True:
-            self.refresh()
             key = self.inputLine.getch()
             if key == ord('q'):
                 return
@@ -96,18 +141,35 @@ class IRCWindow(Thread):
                 self.scrollPos -= 1
             elif key == curses.KEY_DOWN:
                 self.scrollPos += 1
+            dirty = self.applyUpdates() or dirty or key != -1
 
             if self.scrollPos < 0:
                 self.scrollPos = 0
             elif self.scrollPos > self.scrollPosMax:
                 self.scrollPos = self.scrollPosMax
 
+            now = monotonic()
+            if dirty and now - lastDraw >= self.frame:
+                self.refresh()
+                lastDraw = now
+                dirty = False
+
     def refresh(self):
-        self.scroll.refresh(self.scrollPos, 0, 1, 0, self.height - 3, self.width)
+        """Redraws the visible part of the scrollback and the status lines."""
+        self.scroll.erase()
+        for y, row in enumerate(islice(self.rows, self.scrollPos, self.scrollPos + self.viewHeight)):
+            self.scroll.move(y, 0)
+            for text, style in row:
+                self.scroll.addstr(text, style)
+        self.scroll.refresh(0, 0, 1, 0, self.height - 3, self.width - 1)
         self.topLine.addstr(0, 0, self.pad("scrollPosMax: " + str(self.scrollPosMax)), blueBG)
         self.topLine.refresh()
         self.infoLine.addstr(0, 0, self.pad("scrollPos: " + str(self.scrollPos)), blueBG)
         self.infoLine.refresh()
+        self.inputLine.move(0, 0)
+        for text, style in self.input:
+            self.inputLine.addstr(text, style)
+        self.inputLine.clrtoeol()
         self.inputLine.refresh()
 
 # Test Case
@@ -12,27 +12,96 @@ except:
     NO_GUI = True
 import socket
 import logging
+import atexit
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from struct import pack
-from time import time, sleep, localtime, asctime
-from re import match, search, sub
-from os import chdir
-from os.path import isfile, getsize, realpath, dirname
-from math import log
-from threading import Thread, Lock, Condition, Event
+from time import time, sleep, localtime, asctime, monotonic, perf_counter
+from re import search, sub, compile, error as RegexError
+from os import chdir, pipe, close, stat, replace, listdir, truncate
+from errno import ENOSPC
+from os.path import isfile, getsize, realpath, dirname, join
+from select import select
+from math import log, exp
+from collections import deque
+from heapq import heappush, heappop
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from queue import Queue, Empty
+from threading import Thread, Lock, RLock, Condition, Event
 from sys import getfilesystemencoding
 from hashlib import md5
+from zlib import crc32
+import sqlite3
+try:
+    # zero-copy transfers, Linux only
+    from os import splice
+except ImportError:
+    splice = None
+try:
+    from fcntl import fcntl, F_SETPIPE_SZ
+except ImportError:
+    F_SETPIPE_SZ = None
+try:
+    from os import posix_fallocate
+except ImportError:
+    posix_fallocate = None
 
 chdir(realpath(dirname(__file__))) # Switch the current working directory to directory this file is in
 encoding = getfilesystemencoding()
 
-# Set us up a log file
-logging.getLogger().addHandler(logging.FileHandler(filename = "irc.log", mode = "w", encoding = encoding))
-logging.getLogger().setLevel(logging.INFO)
-# Global filesystem lock so threads don't make false assumptions over filesystem info.
-# Acquired whenever a thread wants to access/use filesystem info (EX: os.path.isfile()).
-filesystemLock = Lock()
-# Regular expression string used to parse IRC messages
-MESSAGE_REGEX = r"(:(?P<prefix>((?P<nickname>[^@!\s]+)((((!(?P<user>\S+))?)@(?P<host>\S+))?))|(\S*)) )?(?P<command>\S+) ((?!:)(?P<params>.+?) )?:(?P<trailing>.+)"
+# Wire-level logging of every irc line, off unless configureLogging(level = TRACE)
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+logListener = None
+
+def configureLogging(filename = "irc.log", level = logging.INFO, maxBytes = 10 * 1024 * 1024, backupCount = 3):
+    """
+    Sets up the log file. Threads only put records on a queue,
+    a QueueListener thread does the formatting and file I/O.
+    The file is rolled over when it reaches maxBytes and at startup,
+    so each run starts with a fresh log. Calling it again, to turn
+    on TRACE for example, keeps writing to the current log.
+    """
+    global logListener
+    root = logging.getLogger()
+    starting = logListener is None
+    if not starting:
+        logListener.stop()
+        for handler in logListener.handlers:
+            handler.close()
+        for handler in root.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                root.removeHandler(handler)
+    fileHandler = RotatingFileHandler(filename, maxBytes = maxBytes, backupCount = backupCount, encoding = "UTF-8")
+    if starting and isfile(filename) and getsize(filename) > 0:
+        fileHandler.doRollover()
+    records = Queue()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level)
+    logListener = QueueListener(records, fileHandler)
+    logListener.start()
+
+configureLogging()
+# write out queued records before the interpreter goes away
+atexit.register(lambda: logListener.stop())
+# Precompiled patterns for the bodies of the messages we react to
+DCC_SEND_REGEX = compile(r"\x01DCC SEND \"*([^\"]+)\"* :*(\d+) (\d+) (\d+)")
+DCC_ACCEPT_REGEX = compile(r"\x01DCC ACCEPT (.+) (\d+) (\d+)\x01?$")
+# A packlist line: #pack  downloadsx [size] name
+PACK_REGEX = compile(r"(\S+) +(\d+)x \[([^\[^\]]+)\] ([^\"^\n]+)")
+PACK_SIZE_REGEX = compile(r" *(\d+(?:\.(\d+))?)([KMGTkmgt]?)")
+# one line of an XDCC INFO reply
+INFO_REGEX = compile(r" +(Filename|Sendname|md5sum|crc32) +(\S.*?) *$")
+# the CRC32 release groups put in filenames, e.g. [ABCD1234]
+CRC_TAG_REGEX = compile(r"[\[(]([0-9A-Fa-f]{8})[\])]")
+# iroffer's notice when a request goes into its queue, with the pack and our place if it says
+QUEUED_REGEX = compile(r"\*\* (?:You can only have (\d*).* at a time|All Slots Full), Added you to the main queue for"
+    r"(?: pack(?: \d+)? \(\"(.+?)\"\))?(?: in position (\d+))?")
+# a line of the XDCC QUEUE reply: Queued 0h3m for "name", in position 2 of 5. 0h12m or more remaining.
+QUEUE_REGEX = compile(r"Queued \d+h\d+m for \"(.+?)\", in position (\d+) of (\d+)\. (?:(\d+)h(\d+)m)?")
+# iroffer notices that mean a requested pack won't come
+REJECTED_REGEX = compile(r"\*\* (Invalid Pack Number|XDCC SEND denied)")
 
 
 def parse(filename):
@@ -58,12 +127,14 @@ def parse(filename):
     with open(filename, "r") as f:
         return [l for l in f.read().split("\n") if len(l) > 0 and not l.startswith("#")]
 
-def send(ircConnection, string):
+def send(ircConnection, string, priority = None):
     """
-    Converts a string to bytes with a UTF-8 encoding
-    the bytes are then sent over the socket.
+    Converts a string to bytes with a UTF-8 encoding and queues
+    the bytes for the connection's writer, which sends them over the socket.
     """
-    ircConnection.socket.send(bytes(string, "UTF-8"))
+    ircConnection.outbound.put(bytes(string, "UTF-8"), priority)
+    if ircConnection.engine is not None:
+        ircConnection.engine.wake()
 
 def convertSize(size):
     """Human readable filesize conversion."""
@@ -85,45 +156,1073 @@ def convertSize(size):
         tmp = round(s, 1)
     return "%s %s" % (tmp, names[i])
 
-class TokenBucket(Thread):
+def convertTime(seconds):
+    """Human readable duration, e.g. 1h05m, 3m12s or 9s."""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+class IRCMessage:
+    """An irc line split into its parts. Build these with parseMessage()."""
+    __slots__ = ("raw", "prefix", "nickname", "user", "host", "command", "params", "trailing")
+
+    def __init__(self, raw, prefix, nickname, user, host, command, params, trailing):
+        self.raw = raw
+        self.prefix = prefix
+        self.nickname = nickname
+        self.user = user
+        self.host = host
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+
+def parseMessage(line):
+    """
+    Splits an irc line into prefix, command, params and trailing
+    without running a regex. params holds all middle parameters
+    as one string. When the line has no ' :' the last parameter
+    is used as the trailing part. Returns None for unusable lines.
+    """
+    prefix = nickname = user = host = None
+    rest = line
+    if line.startswith(":"):
+        space = line.find(" ")
+        if space < 0:
+            return None
+        prefix = line[1:space]
+        rest = line[space + 1:]
+        at = prefix.find("@")
+        if at >= 0:
+            host = prefix[at + 1:]
+            nickname = prefix[:at]
+        else:
+            nickname = prefix
+        bang = nickname.find("!")
+        if bang >= 0:
+            user = nickname[bang + 1:]
+            nickname = nickname[:bang]
+    colon = rest.find(" :")
+    if colon >= 0:
+        trailing = rest[colon + 2:]
+        rest = rest[:colon]
+        command, _, params = rest.partition(" ")
+    else:
+        command, _, params = rest.partition(" ")
+        params, _, trailing = params.rpartition(" ")
+        if not trailing:
+            trailing = None
+    if not command:
+        return None
+    return IRCMessage(line, prefix, nickname or None, user, host, command, params or None, trailing)
+
+def packSizeBytes(size):
+    """
+    The smallest byte count a packlist size like "350M" or "1.2G"
+    can stand for, the packlist rounds to its last digit.
+    Returns 0 for sizes that can't be read (or "<1K").
+    """
+    regex = PACK_SIZE_REGEX.match(size)
+    if regex is None:
+        return 0
+    number, fraction, unit = regex.groups()
+    step = 10 ** -len(fraction) if fraction else 1
+    return int(max(0, float(number) - step) * 1024 ** "BKMGT".index(unit.upper() or "B"))
+
+class PackRecord:
+    """One pack of a bot's packlist."""
+    __slots__ = ("pack", "dls", "size", "name")
+
+    def __init__(self, pack, dls, size, name):
+        self.pack = pack
+        self.dls = dls
+        self.size = size
+        self.name = name
+
+def parsePackLine(line):
+    """Returns a PackRecord for a packlist line, None for any other line."""
+    regex = PACK_REGEX.search(line)
+    if regex is None:
+        return None
+    pack, dls, size, name = regex.groups()
+    return PackRecord(pack, int(dls), size, name)
+
+class Watchlist:
+    """
+    The user's packlist regexes, compiled once.
+    A name is first run against a single alternation of every pattern,
+    only names that pass it are tried pattern by pattern to tell which
+    one hit. Patterns with groups would get renumbered in the alternation
+    and inline flags can't be nested, so those are always tried on their own.
+    """
+    def __init__(self, patterns):
+        self.patterns = []
+        self.compiled = []
+        for pattern in patterns:
+            try:
+                self.compiled.append(compile(pattern))
+                self.patterns.append(pattern)
+            except RegexError:
+                logging.warning("Invalid regex in watchlist, ignoring: " + pattern)
+        combinable = []
+        self.separate = []
+        for i, pattern in enumerate(self.patterns):
+            if self.compiled[i].groups == 0 and self.combines(pattern):
+                combinable.append("(?:" + pattern + ")")
+            else:
+                self.separate.append(i)
+        self.prefilter = None
+        if combinable:
+            self.prefilter = compile("|".join(combinable))
+
+    def combines(self, pattern):
+        """Inline flags like (?i) are only allowed at the very start of a regex."""
+        try:
+            compile("(?:" + pattern + ")")
+            return True
+        except RegexError:
+            return False
+
+    def match(self, name):
+        """Index of the first pattern that matches name, None if none does."""
+        if self.prefilter is None or self.prefilter.search(name):
+            candidates = range(len(self.compiled))
+        else:
+            candidates = self.separate
+        for i in candidates:
+            if self.compiled[i].search(name):
+                return i
+        return None
+
+    def matches(self, records):
+        """
+        (record, pattern index) for every record that matches,
+        ordered by pattern the way the patterns were given.
+        """
+        hits = []
+        for record in records:
+            i = self.match(record.name)
+            if i is not None:
+                hits.append((record, i))
+        hits.sort(key = lambda hit: hit[1])
+        return hits
+
+class PacklistSnapshot:
+    """
+    The packs a bot listed at its last poll, by name, and the
+    watchlist they were matched against. Only what diff() reports as
+    new or changed has to be matched again.
+    """
+    def __init__(self):
+        self.packs = dict()
+        self.patterns = None
+
+    def diff(self, records, patterns):
+        """
+        Returns (new, removed, changed) records and keeps records as the snapshot.
+        changed packs kept their name but got a new number or size.
+        A different watchlist makes every pack new.
+        """
+        self.begin(patterns)
+        new = []
+        changed = []
+        for record in records:
+            status = self.add(record)
+            if status == "new":
+                new.append(record)
+            elif status == "changed":
+                changed.append(record)
+        return new, self.end(), changed
+
+    def begin(self, patterns):
+        """Starts taking a packlist one pack at a time with add()."""
+        if patterns != self.patterns:
+            self.packs = dict()
+            self.patterns = list(patterns)
+        self.current = dict()
+
+    def add(self, record):
+        """Returns "new", "changed" or None for a pack that is unchanged."""
+        self.current[record.name] = record
+        old = self.packs.get(record.name)
+        if old is None:
+            return "new"
+        if old.pack != record.pack or old.size != record.size:
+            return "changed"
+        return None
+
+    def end(self, complete = True):
+        """
+        Keeps the packs added since begin() and returns the removed ones.
+        Removals are only known once a packlist has arrived in full.
+        """
+        if not complete:
+            self.packs.update(self.current)
+            return []
+        removed = [record for name, record in self.packs.items() if name not in self.current]
+        self.packs = self.current
+        return removed
+
+    def forget(self, name):
+        """Makes name count as new again at the next poll."""
+        self.packs.pop(name, None)
+
+class PackIndex:
+    """
+    Which bots list each file, across the packlists of every bot polled.
+    Packs with the same name and size are taken to be the same file,
+    so any bot that lists it can stand in for another.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        # stores {bot: pack number} for each (name, size)
+        self.files = dict()
+
+    def key(self, record):
+        return (record.name, packSizeBytes(record.size))
+
+    def add(self, bot, record):
+        with self.lock:
+            self.files.setdefault(self.key(record), dict())[bot] = record.pack
+
+    def remove(self, bot, record):
+        with self.lock:
+            sources = self.files.get(self.key(record))
+            if sources is not None:
+                sources.pop(bot, None)
+                if not sources:
+                    del self.files[self.key(record)]
+
+    def sources(self, record):
+        """{bot: pack number} of every bot listing the file of record."""
+        with self.lock:
+            return dict(self.files.get(self.key(record), ()))
+
+class PacklistReceiver:
+    """
+    Takes the place of the output file of a packlist transfer.
+    Complete lines are parsed as they arrive and handed to whoever
+    iterates over the receiver, so matching starts before the
+    transfer ends and nothing is written to disk.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.records = Queue()
+        self.received = 0
+        self.complete = False
+        self.closed = False
+
+    def write(self, data):
+        self.received += len(data)
+        self.buffer += data
+        end = self.buffer.rfind(b"\n")
+        if end >= 0:
+            self.parse(self.buffer[:end])
+            del self.buffer[:end + 1]
+
+    def parse(self, data):
+        lines = data.decode(encoding, "ignore").splitlines()
+        records = [record for record in map(parsePackLine, lines) if record is not None]
+        if records:
+            self.records.put(records)
+
+    def close(self, complete = False):
+        if self.closed:
+            return
+        self.closed = True
+        self.parse(self.buffer)
+        self.complete = complete
+        self.records.put(None)
+
+    def __iter__(self):
+        while True:
+            records = self.records.get()
+            if records is None:
+                return
+            for record in records:
+                yield record
+
+def parseDCCSend(text):
+    """Returns (filename, ip, port, filesize) from a DCC SEND ctcp or None."""
+    regex = DCC_SEND_REGEX.search(text)
+    if regex is None:
+        return None
+    return (regex.group(1), int(regex.group(2)), int(regex.group(3)), int(regex.group(4)))
+
+def packRanges(packs):
+    """The pack numbers of an XDCC BATCH: ["#2", "#3", "#4", "#7"] -> "2-4,7"."""
+    numbers = sorted(int(pack.lstrip("#")) for pack in packs)
+    ranges = []
+    for n in numbers:
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ",".join(str(a) if a == b else "%d-%d" % (a, b) for a, b in ranges)
+
+class StreamHash:
+    """The MD5 and CRC32 of a file, computed as its bytes go by."""
+    def __init__(self):
+        self.md5 = md5()
+        self.crc = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.crc = crc32(data, self.crc)
+
+    def md5sum(self):
+        return self.md5.hexdigest()
+
+    def crc32sum(self):
+        return "%08X" % self.crc
+
+def hashFile(filename, length = None, chunkSize = 1024 * 1024):
+    """A StreamHash of the first length bytes of a file (all of it by default), read in chunks."""
+    hasher = StreamHash()
+    buf = bytearray(chunkSize)
+    view = memoryview(buf)
+    with open(filename, "rb") as f:
+        left = length
+        while left is None or left > 0:
+            n = f.readinto(buf if left is None or left >= chunkSize else view[:left])
+            if not n:
+                break
+            hasher.update(view[:n])
+            if left is not None:
+                left -= n
+    return hasher
+
+class CatalogEntry:
+    """What the catalog knows about one file."""
+    __slots__ = ("name", "size", "expected", "mtime", "md5", "crc32", "state")
+
+    def __init__(self, name, size, expected = None, mtime = 0, md5 = None, crc32 = None, state = "complete"):
+        self.name = name
+        self.size = size
+        self.expected = expected
+        self.mtime = mtime
+        self.md5 = md5
+        self.crc32 = crc32
+        self.state = state
+
+    def row(self):
+        return (self.name, self.size, self.expected, self.mtime, self.md5, self.crc32, self.state)
+
+class FileCatalog:
+    """
+    The files in the download directory, with their size, hashes and state
+    (partial, complete or verified). Kept in memory so lookups never stat
+    the disk, and mirrored to an sqlite database so hashes survive restarts.
+    A transfer claims its filename before touching the file, which replaces
+    the old global filesystem lock: only transfers after the same name wait.
+    The database is re-synced with the directory when the catalog is opened.
+    """
+    PARTIAL, COMPLETE, VERIFIED = "partial", "complete", "verified"
+
+    def __init__(self, filename = "files.db", directory = "."):
+        self.filename = filename
+        self.lock = Lock()
+        self.files = dict()
+        self.claims = set()
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, "
+            "expected INTEGER, mtime REAL, md5 TEXT, crc32 TEXT, state TEXT)")
+        for row in self.db.execute("SELECT name, size, expected, mtime, md5, crc32, state FROM files"):
+            self.files[row[0]] = CatalogEntry(*row)
+        self.sync(directory)
+
+    def sync(self, directory = "."):
+        """Brings the catalog in line with what is actually in directory."""
+        found = dict()
+        for name in listdir(directory):
+            path = join(directory, name)
+            if isfile(path) and not name.startswith(self.filename):
+                found[name] = stat(path)
+        with self.lock:
+            for name in [name for name in self.files if name not in found]:
+                del self.files[name]
+                self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+            for name, info in found.items():
+                known = self.files.get(name)
+                if known is not None and known.size == info.st_size and known.mtime == info.st_mtime:
+                    continue
+                if known is not None and known.state == self.PARTIAL and known.expected == info.st_size and name not in self.claims:
+                    # preallocated by a transfer that didn't finish, only what it recorded holds data
+                    path = join(directory, name)
+                    truncate(path, known.size)
+                    self.save(CatalogEntry(name, known.size, known.expected, stat(path).st_mtime, state = self.PARTIAL))
+                    continue
+                # new or changed behind our back, the hashes can't be trusted
+                expected = known.expected if known is not None else None
+                state = self.PARTIAL if expected is not None and info.st_size < expected else self.COMPLETE
+                self.save(CatalogEntry(name, info.st_size, expected, info.st_mtime, state = state))
+            self.db.commit()
+
+    def save(self, entry):
+        """Stores entry, the caller holds the lock and commits."""
+        self.files[entry.name] = entry
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", entry.row())
+
+    def get(self, name):
+        with self.lock:
+            return self.files.get(name)
+
+    def size(self, name):
+        """The size of a file, None if there is no such file."""
+        entry = self.get(name)
+        return None if entry is None else entry.size
+
+    def claim(self, name):
+        """Reserves name for one transfer. Returns False if it is already taken."""
+        with self.lock:
+            if name in self.claims:
+                return False
+            self.claims.add(name)
+            return True
+
+    def release(self, name):
+        with self.lock:
+            self.claims.discard(name)
+
+    def update(self, name, size, expected = None, hasher = None, state = None):
+        """Records a file we just wrote to."""
+        mtime = stat(name).st_mtime
+        if state is None:
+            state = self.PARTIAL if expected is not None and size < expected else self.COMPLETE
+        md5sum = crc = None
+        if hasher is not None:
+            md5sum, crc = hasher.md5sum(), hasher.crc32sum()
+        with self.lock:
+            self.save(CatalogEntry(name, size, expected, mtime, md5sum, crc, state))
+            self.db.commit()
+
+    def remove(self, name):
+        with self.lock:
+            self.files.pop(name, None)
+            self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+            self.db.commit()
+
+    def md5(self, name):
+        """The md5sum of a file, hashed in chunks only if the catalog doesn't know it."""
+        entry = self.get(name)
+        if entry is None or entry.md5 is None:
+            hasher = hashFile(name)
+            self.update(name, getsize(name), None if entry is None else entry.expected, hasher,
+                None if entry is None else entry.state)
+            return hasher.md5sum()
+        return entry.md5
+
+# the catalogs opened by this process, shared by every IRCConnection
+catalogs = dict()
+catalogsLock = Lock()
+
+def openCatalog(filename = "files.db"):
+    """The FileCatalog stored in filename, opened once per process."""
+    path = realpath(filename)
+    with catalogsLock:
+        if path not in catalogs:
+            catalogs[path] = FileCatalog(filename)
+        return catalogs[path]
+
+class BotStats:
+    """
+    How each bot has done for us: the average rate of its transfers, how
+    long a request waits for the first byte, and how many transfers failed.
+    Stored in the catalog's database, so the history survives restarts.
+    smoothing: The averages lean on about this many recent transfers.
+    """
+    def __init__(self, filename = "files.db", smoothing = 5):
+        self.smoothing = smoothing
+        self.lock = Lock()
+        self.bots = dict()
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS bots (name TEXT PRIMARY KEY, rate REAL, "
+            "wait REAL, transfers INTEGER, failures INTEGER)")
+        for row in self.db.execute("SELECT name, rate, wait, transfers, failures FROM bots"):
+            self.bots[row[0]] = list(row[1:])
+
+    def rate(self, bot):
+        """Bytes per second, 0 for a bot we know nothing about."""
+        with self.lock:
+            return self.bots[bot][0] if bot in self.bots else 0
+
+    def record(self, bot, ok, rate = None, wait = None):
+        """Adds a finished transfer. rate and wait are only known for those that went through."""
+        with self.lock:
+            stats = self.bots.setdefault(bot, [0, 0, 0, 0])
+            stats[2] += 1
+            if not ok:
+                stats[3] += 1
+            for i, value in ((0, rate), (1, wait)):
+                if value is None:
+                    continue
+                stats[i] = value if stats[i] == 0 else stats[i] + (value - stats[i]) / self.smoothing
+            self.db.execute("INSERT OR REPLACE INTO bots VALUES (?, ?, ?, ?, ?)", [bot] + stats)
+            self.db.commit()
+
+    def expected(self, bot, size):
+        """
+        Seconds a file of size bytes can be expected to take from bot, counting
+        the wait and the transfers that fail. Bots without a rate yet are
+        assumed as fast as the best one, so they get tried.
+        """
+        with self.lock:
+            best = max([stats[0] for stats in self.bots.values()] + [1024 * 1024])
+            rate, wait, transfers, failures = self.bots.get(bot, (0, 0, 0, 0))
+        success = (transfers - failures + 1) / (transfers + 2)
+        return (wait + size / (rate or best)) / success
+
+class Histogram:
+    """Counts of observed values in cumulative buckets, the way Prometheus has them."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        out = []
+        for bound, n in zip(self.buckets + ["+Inf"], self.counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+# seconds, for parsing a line and for whole transfers
+PARSE_BUCKETS = [1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 1e-3]
+TRANSFER_BUCKETS = [1, 10, 60, 300, 900, 1800, 3600, 7200, 14400]
+# transfers add to the metrics about once per this many bytes
+REPORT_BYTES = 1024 * 1024
+
+class Metrics:
+    """
+    Counters, gauges and histograms for one IRCConnection.
+    Any thread may update them, snapshot() and exposition() read them.
+    Labels are keyword arguments: metrics.inc("xdcc_bytes_total", n, bot = "Bot").
+    Collectors are called before every read to fill in gauges that are
+    cheaper to look up than to keep up to date.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.collectors = []
+
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value = 1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def add(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, buckets, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def collect(self, collector):
+        """Registers collector(metrics), called before the metrics are read."""
+        self.collectors.append(collector)
+
+    def series(self, name, labels, extra = ()):
+        labels = labels + tuple(extra)
+        if not labels:
+            return name
+        return name + "{" + ",".join("%s=\"%s\"" % (k, str(v).replace("\\", "\\\\").replace("\"", "\\\"")) for k, v in labels) + "}"
+
+    def snapshot(self):
+        """Every value keyed by its series name, histograms as dicts of count, sum and buckets."""
+        for collector in self.collectors:
+            collector(self)
+        with self.lock:
+            out = dict()
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                out[self.series(name, labels)] = value
+            for (name, labels), histogram in self.histograms.items():
+                out[self.series(name, labels)] = {"count": histogram.count, "sum": histogram.sum,
+                    "buckets": dict(histogram.cumulative())}
+            return out
+
+    def exposition(self):
+        """The metrics in the Prometheus text format."""
+        for collector in self.collectors:
+            collector(self)
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append("# TYPE %s %s" % (name, kind))
+                    lines.append("%s %s" % (self.series(name, labels), repr(float(value))))
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append("# TYPE %s histogram" % name)
+                for bound, total in histogram.cumulative():
+                    lines.append("%s %d" % (self.series(name + "_bucket", labels, [("le", bound)]), total))
+                lines.append("%s %s" % (self.series(name + "_sum", labels), repr(histogram.sum)))
+                lines.append("%s %d" % (self.series(name + "_count", labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """Writes the exposition to filename, replacing it in one step so readers never see half a file."""
+        with open(filename + ".tmp", "w") as f:
+            f.write(self.exposition())
+        replace(filename + ".tmp", filename)
+
+class MetricsWriter(Thread):
+    """Writes an IRCConnection's metrics to a file every interval seconds, e.g. for node_exporter's textfile collector."""
+    def __init__(self, metrics, filename, interval = 10):
+        Thread.__init__(self)
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.daemon = True
+
+    def run(self):
+        while True:
+            try:
+                self.metrics.write(self.filename)
+            except OSError as e:
+                logging.warning("Unable to write metrics: {0}".format(e))
+            sleep(self.interval)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answers GET /metrics with the exposition of server.metrics."""
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.exposition().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serveMetrics(metrics, port, host = "127.0.0.1"):
+    """Serves metrics at http://host:port/metrics from a daemon thread. Returns the server."""
+    server = MetricsServer((host, port), MetricsHandler)
+    server.metrics = metrics
+    thread = Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+class BandwidthSchedule:
+    """
+    A rate in KiB/s that depends on the time of day.
+    rates maps the hour (0-24, fractions allowed) a rate starts at to the rate,
+    0 meaning unlimited. BandwidthSchedule({8: 200, 23: 0}) allows 200 KiB/s
+    from 8:00 to 23:00 and anything at night.
+    Can be passed anywhere a rate is expected.
+    """
+    def __init__(self, rates):
+        self.rates = sorted(rates.items())
+
+    def __call__(self):
+        now = localtime()
+        hour = now.tm_hour + now.tm_min / 60
+        # before the first start of the day the last rate still applies
+        rate = self.rates[-1][1]
+        for start, r in self.rates:
+            if start > hour:
+                break
+            rate = r
+        return rate
+
+class RateLimiter:
+    """
+    A RateLimiter caps a byte rate without a thread of its own.
+    The allowance is topped up from the clock whenever bytes are
+    charged, and the actual number of bytes received is charged.
+    Bytes charged to a limiter are charged to its parent as well,
+    giving a global -> bot -> transfer hierarchy. Concurrent transfers
+    under one parent each wait out the parent's shared debt, so they
+    get about the same share.
+
+    rate: KiB/s, 0 for no limit, or a BandwidthSchedule.
+    burst: Seconds' worth of bytes that may be saved up.
+    """
+    def __init__(self, rate, parent = None, burst = 1.0):
+        self.rate = rate
+        self.parent = parent
+        self.burst = burst
+        self.allowance = 0.0
+        self.stamp = monotonic()
+        self.lock = Lock()
+        self.currentRate = 0
+        self.checked = 0
+
+    def bytesPerSecond(self, now):
+        # schedules are looked up at most once a second
+        if now - self.checked >= 1:
+            self.checked = now
+            rate = self.rate() if callable(self.rate) else self.rate
+            self.currentRate = rate * 1024
+        return self.currentRate
+
+    def charge(self, n, now):
+        """Takes n bytes from the allowance. Returns the seconds until it is paid back."""
+        with self.lock:
+            rate = self.bytesPerSecond(now)
+            if rate <= 0:
+                self.allowance = 0.0
+                self.stamp = now
+                return 0
+            self.allowance = min(rate * self.burst, self.allowance + (now - self.stamp) * rate) - n
+            self.stamp = now
+            if self.allowance >= 0:
+                return 0
+            return -self.allowance / rate
+
+    def reserve(self, n):
+        """
+        Charges n bytes here and to every parent.
+        Returns how long the caller should wait before receiving more.
+        """
+        now = monotonic()
+        wait = 0
+        limiter = self
+        while limiter is not None:
+            wait = max(wait, limiter.charge(n, now))
+            limiter = limiter.parent
+        return wait
+
+    def consume(self, n):
+        """Charges n bytes and sleeps until they are within the limit."""
+        wait = self.reserve(n)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def lowestRate(self):
+        """The tightest limit in the hierarchy in bytes per second, 0 if there is none."""
+        now = monotonic()
+        lowest = 0
+        limiter = self
+        while limiter is not None:
+            rate = limiter.bytesPerSecond(now)
+            if rate > 0 and (lowest == 0 or rate < lowest):
+                lowest = rate
+            limiter = limiter.parent
+        return lowest
+
+class OutboundQueue:
     """
-    A TokenBucket helps with rate limiting.
-    The bucket fills with gainAmmount tokens every gainRate secods.
-    It fills until the bucket contains maxTokens tokens.
-    You can request a token from the bucket. If the bucket has
-    a token you continue, otherwise you must wait until
-    the bucket has been filled.
+    Lines waiting to be written to the irc socket, in priority order.
+    Servers disconnect clients that send too much at once (Excess Flood),
+    so lines are let out against a budget: burst lines at once, refilled
+    by one line every interval seconds. Urgent lines (PONG, registration)
+    jump the queue and are never held back by the budget.
+    Until the server has welcomed us only urgent lines go out.
+    Whatever the budget allows at once is joined into one write.
+    """
+    URGENT, NORMAL, BULK = 0, 1, 2
+
+    def __init__(self, burst = 5, interval = 2.0):
+        self.burst = burst
+        self.interval = interval
+        self.allowance = burst
+        self.last = monotonic()
+        self.lines = []
+        self.count = 0
+        self.registering = True
+        # get calls take with the lock held
+        self.condition = Condition(RLock())
+
+    def priority(self, line):
+        command = line.split(b" ", 1)[0]
+        if command in (b"PONG", b"PASS", b"NICK", b"USER", b"QUIT"):
+            return self.URGENT
+        if b" :XDCC " in line:
+            return self.BULK
+        return self.NORMAL
+
+    def put(self, line, priority = None):
+        if priority is None:
+            priority = self.priority(line)
+        with self.condition:
+            # count keeps lines of the same priority in order
+            heappush(self.lines, (priority, self.count, line))
+            self.count += 1
+            self.condition.notify()
+
+    def take(self, now):
+        """
+        Pops every line the budget allows at now.
+        Returns the lines joined, and how long until the next one
+        is allowed (None if that is up to a put or registered).
+        """
+        with self.condition:
+            self.allowance = min(self.burst, self.allowance + (now - self.last) / self.interval)
+            self.last = now
+            out = []
+            while self.lines:
+                if self.lines[0][0] != self.URGENT:
+                    if self.registering or self.allowance < 1:
+                        break
+                    self.allowance -= 1
+                out.append(heappop(self.lines)[2])
+            wait = None
+            if self.lines and not self.registering:
+                wait = (1 - self.allowance) * self.interval
+            return b"".join(out), wait
+
+    def get(self):
+        """Blocks until some lines may be sent and returns them."""
+        with self.condition:
+            while True:
+                data, wait = self.take(monotonic())
+                if data:
+                    return data
+                self.condition.wait(wait)
+
+    def reset(self):
+        """A new connection: hold everything but registration until we're welcomed."""
+        with self.condition:
+            self.registering = True
+            self.allowance = self.burst
+
+    def registered(self):
+        with self.condition:
+            self.registering = False
+            self.condition.notify()
+
+
+class DiskWriter(Thread):
     """
-    def __init__(self, startTokens, gainRate, maxTokens, gainAmmount = 1):
+    A DiskWriter writes a transfer's data to disk on its own thread, so a
+    slow disk doesn't stall the socket. The receiving side fills one of
+    buffers free buffers of bufferSize bytes and hands it over with write.
+    Once all of them are waiting to be written, buffer blocks: that
+    backpressure is what keeps the memory bounded.
+    offset: Where in the file the data starts, for resumed transfers.
+    hasher: A StreamHash fed what is written.
+    checkpoint: Called with the bytes written so far every checkpointInterval
+        seconds, so a crash doesn't lose track of a preallocated file.
+    """
+    def __init__(self, file, buffers = 4, bufferSize = 1024 * 1024, offset = 0, hasher = None, checkpoint = None, checkpointInterval = 10):
         Thread.__init__(self)
-        self.tokens = startTokens
-        self.gainRate = gainRate
-        self.gainAmmount = gainAmmount
-        self.maxTokens = maxTokens
-        self.tokenCondition = Condition(Lock())
-        self.die = False
+        self.file = file
+        self.hasher = hasher
+        self.checkpoint = checkpoint
+        self.checkpointInterval = checkpointInterval
+        self.free = Queue()
+        for i in range(buffers):
+            self.free.put(bytearray(bufferSize))
+        self.filled = Queue()
+        # how far into the file the data reaches
+        self.written = offset
+        # the OSError that stopped writing, the receiving side checks it
+        self.error = None
         self.daemon = True
         self.start()
 
+    def buffer(self, block = True):
+        """A free buffer, None if block is False and there is none."""
+        try:
+            return self.free.get(block)
+        except Empty:
+            return None
+
+    def write(self, buf, n):
+        """Queues the first n bytes of buf, which goes back to the pool once written."""
+        self.filled.put((buf, n))
+
     def run(self):
-        while not self.die:
-            sleep(self.gainRate)
-            with self.tokenCondition:
-                self.tokens = min(self.maxTokens,
-                    self.tokens + self.gainAmmount)
-                self.tokenCondition.notify()
+        lastCheckpoint = monotonic()
+        while True:
+            item = self.filled.get()
+            if item is None:
+                return
+            buf, n = item
+            if self.error is None:
+                try:
+                    self.file.write(memoryview(buf)[:n])
+                    if self.hasher is not None:
+                        self.hasher.update(memoryview(buf)[:n])
+                    self.written += n
+                except OSError as e:
+                    self.error = e
+            # buffers keep coming back after an error so the receiver never blocks on them
+            self.free.put(buf)
+            if self.checkpoint is not None and self.error is None and monotonic() - lastCheckpoint > self.checkpointInterval:
+                self.file.flush()
+                self.checkpoint(self.written)
+                lastCheckpoint = monotonic()
 
-    def stop(self):
-        self.die = True
-        self.tokenConidtion.notifyAll()
+    def close(self):
+        """Waits until everything queued is on disk."""
+        self.filled.put(None)
+        self.join()
 
-    def getToken(self):
-        while not self.die:
-            with self.tokenCondition:
-                if self.tokens >= 1:
-                    self.tokens -= 1
-                    return True
-                self.tokenCondition.wait()
+class ProgressReporter(Thread):
+    """
+    A ProgressReporter samples the bytesReceived of every running
+    transfer each interval seconds and shows one status line for all
+    of them. Transfers never call into it, so reporting costs them
+    nothing but the counter they keep anyway.
+    Rates are smoothed with an exponentially weighted moving average
+    with a time constant of smoothing seconds.
+    """
+    def __init__(self, ircConnection, interval = 1.0, smoothing = 5.0, monitor = None):
+        Thread.__init__(self)
+        self.ircCon = ircConnection
+        self.interval = interval
+        self.smoothing = smoothing
+        # a StallMonitor shown every sample
+        self.monitor = monitor
+        # stores [bytesReceived, time, rate] at the last sample of each transfer
+        self.transfers = dict()
+        self.lock = Lock()
+        self.daemon = True
+
+    def add(self, dcc):
+        with self.lock:
+            self.transfers[dcc] = None
+
+    def remove(self, dcc):
+        with self.lock:
+            self.transfers.pop(dcc, None)
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            now = monotonic()
+            samples = self.sample(now)
+            if self.monitor is not None:
+                self.monitor.check(samples, now)
+            line = self.render(samples)
+            if line is None:
+                continue
+            if self.ircCon.gui is None:
+                self.ircCon.lockPrint(line)
+            else:
+                self.ircCon.gui.addInput(line, begin = True, pad = True)
+
+    def sample(self, now):
+        """
+        Updates the smoothed rate of each transfer.
+        Returns a list of (dcc, received, rate) tuples.
+        """
+        samples = []
+        with self.lock:
+            for dcc, last in self.transfers.items():
+                # a plain read, the transfer may be adding to it right now
+                received = dcc.bytesReceived
+                if received >= dcc.filesize:
+                    # done, maybe still being verified
+                    continue
+                if last is None:
+                    # the first sample only sets the starting point, resumes don't count
+                    self.transfers[dcc] = [received, now, 0.0]
+                    samples.append((dcc, received, 0.0))
+                    continue
+                elapsed = now - last[1]
+                if elapsed > 0:
+                    current = (received - last[0]) / elapsed
+                    if last[2] == 0:
+                        last[2] = current
+                    else:
+                        last[2] += (1 - exp(-elapsed / self.smoothing)) * (current - last[2])
+                    last[0], last[1] = received, now
+                samples.append((dcc, received, last[2]))
+        return samples
+
+    def render(self, samples):
+        """Formats samples as a status line, None if nothing is running."""
+        if not samples:
+            return None
+        received = sum(s[1] for s in samples)
+        size = sum(s[0].filesize for s in samples)
+        rate = sum(s[2] for s in samples)
+        if len(samples) == 1:
+            name = samples[0][0].filename
+        else:
+            name = "%d transfers" % len(samples)
+        line = "%s %s/s [%s/%s]" % (name, convertSize(int(rate)), convertSize(received), convertSize(size))
+        if rate > 0:
+            line += " ETA " + convertTime((size - received) / rate)
+        return line
+
+class StallMonitor:
+    """
+    A StallMonitor cancels transfers that have slowed to a trickle, so they
+    stop holding the bot's slot. A transfer stalls once its rate has stayed
+    under the floor for stallTime seconds: stallRate KiB/s, or stallFraction
+    of what the bot managed on average, whichever is higher. The partial
+    file is kept and the DownloadScheduler asks for the pack again.
+    """
+    def __init__(self, ircConnection, stallRate = 1, stallFraction = 0.1, stallTime = 60):
+        self.ircCon = ircConnection
+        self.stallRate = stallRate * 1024
+        self.stallFraction = stallFraction
+        self.stallTime = stallTime
+        # stores when each slow transfer fell under the floor
+        self.slowSince = dict()
+
+    def floor(self, bot):
+        return max(self.stallRate, self.stallFraction * self.ircCon.botStats.rate(bot))
+
+    def check(self, samples, now):
+        """Looks at samples from ProgressReporter.sample and cancels the transfers that stalled."""
+        if not self.stallTime:
+            return
+        slow = dict()
+        for dcc, received, rate in samples:
+            # packlists are short, and nothing has been asked of the socket before the first byte
+            if dcc.job is None or dcc.job.firstByte is None or dcc.stalled:
+                continue
+            if rate >= self.floor(dcc.bot):
+                continue
+            slow[dcc] = self.slowSince.get(dcc, now)
+            if now - slow[dcc] >= self.stallTime:
+                self.stall(dcc, now - slow[dcc])
+        self.slowSince = slow
+
+    def stall(self, dcc, wasted):
+        dcc.stalled = True
+        self.ircCon.pout((("Transfer of ", gui.cyanText), (dcc.filename, None),
+            (" stalled under " + convertSize(int(self.floor(dcc.bot))) + "/s, cancelling it.\n", gui.redText)))
+        self.ircCon.metrics.inc("xdcc_stalls_total", bot = dcc.bot)
+        # slot time spent below the floor
+        self.ircCon.metrics.inc("xdcc_stalled_seconds_total", wasted, bot = dcc.bot)
+        self.ircCon.msg(dcc.bot, "XDCC CANCEL")
+        # the receive loop sees the socket close and keeps what arrived
+        try:
+            dcc.socket.shutdown(socket.SHUT_RDWR)
+        except (OSError, AttributeError):
+            pass
 
 class DCCThread(Thread):
     """
@@ -139,101 +1238,440 @@ class DCCThread(Thread):
         self.filesize = filesize
         self.bot = sender
         self.md5check = md5check
+        self.socket = None
+        self.file = None
+        self.bytesReceived = 0
+        # the DownloadJob this offer answers, None for packlists
+        self.job = None
+        # a PacklistReceiver used instead of a file on disk
+        self.sink = None
+        # a StreamHash fed by the receive loop when transfers are verified
+        self.hasher = None
+        # whether this transfer holds the catalog claim on filename
+        self.claimed = False
+        # True once the whole file is on disk
+        self.done = False
+        # set by the StallMonitor when it cancels the transfer
+        self.stalled = False
+        # where a resumed transfer started
+        self.offset = 0
+        # the DiskWriter of a file transfer, None to write inline
+        self.writer = None
+        # the memoryview being received into and how much of it is filled
+        self.buffer = None
+        self.filled = 0
+        self.chunkSize = ircConnection.chunkSize
+        self.limiter = ircConnection.limiterFor(sender)
+        if self.limiter is not None:
+            # smaller reads keep a limited transfer smooth, about 8 per second
+            self.chunkSize = int(min(self.chunkSize, max(4096, self.limiter.lowestRate() / 8)))
+        # progress is only looked at once this many bytes have arrived
+        self.nextReport = 0
+        self.started = time()
+        # bytes and limiter waits not yet added to the metrics
+        self.counted = 0
+        self.limiterWait = 0.0
 
     def run(self):
+        # the file comes first, a resume has to be agreed on before connecting
+        if not self.openFile():
+            return False
+        if not self.connect():
+            self.closeFile()
+            sleep(3)
+            return
+        try:
+            if self.canSplice():
+                self.spliceLoop()
+            else:
+                self.receiveLoop()
+            self.complete()
+        except Exception as e:
+            self.ircCon.printAndLogInfo("Exception occurred during file writing.")
+        return True
+
+    def receiveLoop(self):
+        """
+        Reads the file straight into the writer's buffers with recv_into.
+        Returns False if the socket raised an error.
+        """
+        limiter = self.limiter
+        recv_into = self.socket.recv_into
+        while self.bytesReceived != self.filesize:
+            try:
+                n = recv_into(self.receiveBuffer())
+            except socket.error as socketerror:
+                self.recvError(socketerror)
+                return False
+            if not self.received(n):
+                break
+            if limiter is not None:
+                self.limiterWait += limiter.consume(n)
+        return True
+
+    def canSplice(self):
+        """Splicing needs Linux and nothing that has to see the bytes in python."""
+        return (self.ircCon.zeroCopy and splice is not None and self.limiter is None
+            and self.sink is None and self.hasher is None)
+
+    def spliceLoop(self):
+        """
+        Moves the file from the socket to disk through a pipe with os.splice,
+        so the data is never copied into python.
+        Returns False if the socket raised an error.
+        """
+        self.openPipe()
+        try:
+            timeout = self.socket.gettimeout()
+            while self.bytesReceived != self.filesize:
+                try:
+                    n = self.spliceChunk()
+                except BlockingIOError:
+                    # sockets with a timeout are non-blocking underneath
+                    if not select([self.socket], [], [], timeout)[0]:
+                        self.recvError(socket.timeout("timed out"))
+                        return False
+                    continue
+                except OSError as socketerror:
+                    self.recvError(socketerror)
+                    return False
+                if n == 0:
+                    self.socketClosed()
+                    break
+        finally:
+            self.closePipe()
+        return True
+
+    def openPipe(self):
+        self.pipe = pipe()
+        self.pipeSize = 65536
+        if F_SETPIPE_SZ is not None:
+            try:
+                self.pipeSize = fcntl(self.pipe[1], F_SETPIPE_SZ, self.chunkSize)
+            except OSError:
+                pass
+
+    def closePipe(self):
+        close(self.pipe[0])
+        close(self.pipe[1])
+
+    def spliceChunk(self):
+        """
+        Splices whatever the socket has (up to the pipe size) into the file.
+        Returns the number of bytes moved, 0 once the socket has closed.
+        Raises BlockingIOError if no data is waiting.
+        """
+        n = splice(self.socket.fileno(), self.pipe[1], min(self.pipeSize, self.filesize - self.bytesReceived))
+        left = n
+        while left > 0:
+            left -= splice(self.pipe[0], self.file.fileno(), left)
+        self.bytesReceived += n
+        if self.bytesReceived >= self.nextReport:
+            self.report(time())
+        return n
+
+    def connect(self):
+        """Connect to the sender. Returns False if the connection failed."""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(300)
+        self.socket.settimeout(self.ircCon.dccTimeout)
         try:
             self.socket.connect((self.host, self.port))
         except Exception as e:
-            self.ircCon.logInfo("error: {0}".format(e))
-            self.ircCon.printAndLogInfo("Socket error, trying again.")
-            self.ircCon.msg(self.bot, "XDCC CANCEL")
-            self.ircCon.lastRequestedPack[self.bot] = None
-            sleep(3)
-            return
-        # make sure we are the only thread looking at the filesystem
-        filesystemLock.acquire()
+            self.connectFailed(e)
+            return False
+        return True
+
+    def connectFailed(self, e):
+        self.ircCon.logInfo("error: {0}".format(e))
+        self.ircCon.printAndLogInfo("Socket error, trying again.")
+        self.ircCon.msg(self.bot, "XDCC CANCEL")
+        self.ircCon.lastRequestedPack[self.bot] = None
+
+    def openFile(self):
+        """
+        Resolves filename conflicts and opens the output file.
+        A partial file is resumed if the sender accepts.
+        Returns False if there is nothing to receive.
+        """
+        if self.sink is not None:
+            self.file = self.sink
+            self.ircCon.pout((("Receiving packlist", gui.cyanText), (" from " + self.bot + " ", None), ("[" + convertSize(self.filesize) + "]\n", gui.greenText)))
+            return True
+        catalog = self.ircCon.catalog
+        # make sure we are the only transfer writing this file
+        if not catalog.claim(self.filename):
+            self.ircCon.pout(((self.filename, None), (" is already being received, closing socket.\n", gui.redText)))
+            return False
+        self.claimed = True
+        partial = 0
         # File conflict resolution
-        while isfile(self.filename):
+        while catalog.get(self.filename) is not None:
+            if self.isPartial():
+                partial = catalog.size(self.filename)
+                break
             if self.shouldOverwrite():
                 break
             if self.shouldRename():
                 continue
             self.ircCon.pout(((self.filename, None), (" already exists, closing socket.\n", gui.redText)))
-            self.socket.close()
-            filesystemLock.release()
+            self.done = True
             return False
-        self.ircCon.pout((("Downloading", gui.cyanText), (" " + self.filename + " ", None), ("[" + convertSize(self.filesize) + "]\n", gui.greenText)))
-        f = None
-        try:
-            f = open(self.filename, "wb")
-        except OSError:
-            self.socket.close()
-            return
-        finally:
-            # we should be good to let other threads look at the filesystem
-            filesystemLock.release()
+        if partial == 0:
+            try:
+                self.file = open(self.filename, "wb")
+            except OSError:
+                return False
+            catalog.update(self.filename, 0, self.filesize)
+        if partial > 0:
+            self.bytesReceived = self.counted = self.offset = self.requestResume(partial)
+            try:
+                self.file = open(self.filename, "r+b")
+                self.file.seek(self.bytesReceived)
+                self.file.truncate()
+            except OSError:
+                return False
+            catalog.update(self.filename, self.bytesReceived, self.filesize)
+            self.ircCon.pout((("Resuming", gui.cyanText), (" " + self.filename + " ", None), ("[" + convertSize(self.bytesReceived) + "/" + convertSize(self.filesize) + "]\n", gui.greenText)))
+        else:
+            self.ircCon.pout((("Downloading", gui.cyanText), (" " + self.filename + " ", None), ("[" + convertSize(self.filesize) + "]\n", gui.greenText)))
+        if not self.preallocate():
+            self.file.close()
+            return False
+        if self.ircCon.verify:
+            self.startHashing()
+        if self.ircCon.writeBuffers and not self.canSplice():
+            self.writer = DiskWriter(self.file, self.ircCon.writeBuffers, max(self.chunkSize, self.ircCon.writeBufferSize),
+                self.bytesReceived, self.hasher, self.checkpoint)
+        return True
+
+    def preallocate(self):
+        """
+        Reserves the rest of the file on disk in one go, so it isn't
+        fragmented or grown a write at a time.
+        Returns False if the disk is too full to hold it.
+        """
+        if posix_fallocate is None or self.bytesReceived >= self.filesize:
+            return True
         try:
-            lastTime = time()
-            lastTotal = 0
-            bytesReceived = 0
-            while bytesReceived != self.filesize:
-                try:
-                    self.ircCon.bucket.getToken()
-                except AttributeError:
-                    pass
-                tmp = None
-                try:
-                    tmp = self.socket.recv(4096)
-                except socket.error as socketerror:
-                    self.ircCon.lockPrint("Error: " + str(socketerror))
-                    logging.warning("Exception occurred during DCC recv.")
-                    self.socket.close()
-                    return
-                bytesReceived += len(tmp)
-                if len(tmp) <= 0:
-                    self.ircCon.lockPrint("DCC Error: Socket closed.")
-                    logging.warning("DCC Error: Socket closed.")
-                    break
-                f.write(tmp)
-                now = time()
-                if now - lastTime > 0.5:
-                    rate = int((bytesReceived - lastTotal)/(now - lastTime))
-                    lastTime = now
-                    lastTotal = bytesReceived
-                    if self.ircCon.gui is None:
-                        self.ircCon.lockPrint(convertSize(rate) + "/s [" +
-                            convertSize(bytesReceived) + "/" + convertSize(self.filesize) + "] ")
-                    else:
-                        self.ircCon.gui.addInput(convertSize(rate) + "/s", begin = True)
-                        self.ircCon.gui.addInput(" [" + convertSize(bytesReceived) + "/" + convertSize(self.filesize) + "]", gui.greenText, pad = True)
-            f.close()
-            self.ircCon.pout((("Transfer of ", gui.cyanText), (self.filename, None), (" complete.\n", gui.cyanText)), clearInput = True)
-        except Exception as e:
-            self.ircCon.printAndLogInfo("Exception occurred during file writing.")
+            posix_fallocate(self.file.fileno(), self.bytesReceived, self.filesize - self.bytesReceived)
+        except OSError as e:
+            if e.errno == ENOSPC:
+                self.ircCon.pout(((self.filename, None), (" doesn't fit on the disk, closing socket.\n", gui.redText)))
+                return False
+            # the filesystem can't, the file just grows as it is written
+        return True
+
+    def checkpoint(self, written):
+        """Records how much of the preallocated file holds data."""
+        self.ircCon.catalog.update(self.filename, written, self.filesize)
+
+    def startHashing(self):
+        """Hashes what is already on disk and asks the bot for its md5sum."""
+        if self.bytesReceived > 0:
+            self.hasher = hashFile(self.filename, self.bytesReceived)
+        else:
+            self.hasher = StreamHash()
+        if self.job is not None:
+            self.ircCon.fileInfo.pop(self.filename, None)
+            self.ircCon.infoEvents[self.filename] = Event()
+            self.ircCon.msg(self.bot, "XDCC INFO %s" % self.job.pack)
+
+    def verify(self):
+        """
+        Checks the finished file against the md5sum and crc32 from XDCC INFO
+        and the CRC32 tag in its name. A file that fails is renamed to
+        .corrupt so it gets downloaded again. Returns whether it passed.
+        """
+        md5sum, crc = self.hasher.md5sum(), self.hasher.crc32sum()
+        # small files can finish before the XDCC INFO reply arrives
+        event = self.ircCon.infoEvents.get(self.filename)
+        if event is not None:
+            event.wait(10)
+            self.ircCon.infoEvents.pop(self.filename, None)
+        info = self.ircCon.fileInfo.pop(self.filename, {})
+        tags = CRC_TAG_REGEX.findall(self.filename)
+        failed = []
+        if "md5sum" in info and info["md5sum"].lower() != md5sum:
+            failed.append("md5sum " + md5sum + " != " + info["md5sum"])
+        if "crc32" in info and info["crc32"].upper() != crc:
+            failed.append("crc32 " + crc + " != " + info["crc32"])
+        if tags and tags[-1].upper() != crc:
+            failed.append("crc32 " + crc + " != " + tags[-1])
+        if failed:
+            self.ircCon.pout(((self.filename, None), (" is corrupt (" + ", ".join(failed) + ").\n", gui.redText)))
+            replace(self.filename, self.filename + ".corrupt")
+            self.ircCon.catalog.remove(self.filename)
+            return False
+        self.ircCon.catalog.update(self.filename, self.bytesReceived, self.filesize, self.hasher,
+            FileCatalog.VERIFIED if tags or info else FileCatalog.COMPLETE)
         return True
 
+    def isPartial(self):
+        """Whether the existing file is shorter than the one on offer. Packlists are never resumed."""
+        if search(r".txt\Z", self.filename):
+            return False
+        return self.ircCon.catalog.size(self.filename) < self.filesize
+
+    def requestResume(self, position):
+        """
+        Sends a DCC RESUME and waits for the sender's DCC ACCEPT.
+        Returns the position to continue from, 0 if the sender didn't accept.
+        """
+        key = (self.bot, self.port)
+        event = self.ircCon.resumeEvents[key] = Event()
+        filename = self.filename
+        if " " in filename:
+            filename = "\"" + filename + "\""
+        self.ircCon.ctcp(self.bot, "DCC RESUME %s %d %d" % (filename, self.port, position))
+        accepted = event.wait(30)
+        del self.ircCon.resumeEvents[key]
+        if not accepted:
+            self.ircCon.logInfo("No DCC ACCEPT for " + self.filename + ", starting over.")
+            return 0
+        return min(position, self.ircCon.resumeOffsets.pop(key))
+
+    def receiveBuffer(self, block = True):
+        """
+        The memory to recv_into next, at most chunkSize bytes of a writer
+        buffer. Blocks while the writer is behind unless block is False,
+        then it returns None instead.
+        """
+        if self.buffer is None:
+            if self.writer is None:
+                self.buffer = memoryview(bytearray(self.chunkSize))
+            else:
+                buf = self.writer.buffer(block)
+                if buf is None:
+                    return None
+                self.buffer = memoryview(buf)
+            self.filled = 0
+        return self.buffer[self.filled:min(len(self.buffer), self.filled + self.chunkSize,
+            self.filled + self.filesize - self.bytesReceived)]
+
+    def received(self, n):
+        """Takes the n bytes that arrived in receiveBuffer. Returns False once the transfer should stop."""
+        if n <= 0:
+            self.socketClosed()
+            return False
+        self.bytesReceived += n
+        if self.writer is None:
+            data = self.buffer[:n]
+            self.file.write(data)
+            if self.hasher is not None:
+                self.hasher.update(data)
+        else:
+            self.filled += n
+            if self.filled == len(self.buffer) or self.bytesReceived == self.filesize:
+                self.flushBuffer()
+            if self.writer.error is not None:
+                self.writeError(self.writer.error)
+                return False
+        if self.bytesReceived >= self.nextReport:
+            self.report(time())
+        return True
+
+    def flushBuffer(self):
+        """Hands the filled part of the current buffer to the writer."""
+        if self.writer is not None and self.buffer is not None:
+            self.writer.write(self.buffer.obj, self.filled)
+            self.buffer = None
+
+    def written(self):
+        """The bytes that made it to the file."""
+        if self.writer is None:
+            return self.bytesReceived
+        return self.writer.written
+
+    def closeFile(self):
+        """
+        Flushes the writer and closes the file. The preallocated space a
+        short transfer didn't fill is cut off again, so the file can be resumed.
+        """
+        if self.writer is not None:
+            self.flushBuffer()
+            self.writer.close()
+            if self.writer.error is not None:
+                self.writeError(self.writer.error)
+        if self.sink is None:
+            try:
+                if self.written() < self.filesize:
+                    self.file.truncate(self.written())
+            except OSError as e:
+                self.writeError(e)
+        self.file.close()
+
+    def socketClosed(self):
+        if self.stalled:
+            return
+        self.ircCon.lockPrint("DCC Error: Socket closed.")
+        logging.warning("DCC Error: Socket closed.")
+
+    def report(self, now):
+        """
+        Notes the first byte and adds progress to the metrics.
+        Called every REPORT_BYTES or so rather than per chunk,
+        the ProgressReporter reads bytesReceived on its own.
+        """
+        if self.job is not None and self.job.firstByte is None:
+            self.job.firstByte = now
+        self.countBytes()
+        self.nextReport = self.bytesReceived + max(self.chunkSize, REPORT_BYTES)
+
+    def countBytes(self):
+        """Adds what arrived since the last call to the connection's metrics."""
+        metrics = self.ircCon.metrics
+        metrics.inc("xdcc_received_bytes_total", self.bytesReceived - self.counted, bot = self.bot)
+        self.counted = self.bytesReceived
+        if self.limiterWait:
+            metrics.inc("xdcc_limiter_wait_seconds_total", self.limiterWait, bot = self.bot)
+            self.limiterWait = 0.0
+
+    def writeError(self, e):
+        self.ircCon.printAndLogInfo("Error writing " + self.filename + ": " + str(e))
+
+    def recvError(self, socketerror):
+        self.ircCon.lockPrint("Error: " + str(socketerror))
+        logging.warning("Exception occurred during DCC recv.")
+
+    def complete(self):
+        """Closes the transfer. A short file is kept so it can be resumed."""
+        self.socket.close()
+        if self.sink is not None:
+            # the receiver is closed once the transfer is finished
+            self.done = self.bytesReceived >= self.filesize
+            return
+        self.closeFile()
+        written = self.written()
+        if self.hasher is None or written < self.filesize:
+            self.ircCon.catalog.update(self.filename, written, self.filesize)
+        if written < self.filesize:
+            self.ircCon.pout((("Transfer of ", gui.cyanText), (self.filename, None), (" stopped at " + convertSize(written) + "/" + convertSize(self.filesize) + ", it will be resumed.\n", gui.redText)), clearInput = True)
+            return
+        if self.hasher is not None and not self.verify():
+            return
+        self.done = True
+        self.ircCon.pout((("Transfer of ", gui.cyanText), (self.filename, None), (" complete.\n", gui.cyanText)), clearInput = True)
+
     def shouldOverwrite(self): # Perhaps take in user input?
         if search(r".txt\Z", self.filename):
             if self.md5check:
-                if getsize(self.filename) != self.filesize:
+                if self.ircCon.catalog.size(self.filename) != self.filesize:
                     return True
                 else:
                     self.ircCon.md5Conditions[self.bot] = Condition(Lock())
                     md5NotEqual = True
                     with self.ircCon.md5Conditions[self.bot]:
-                        # TODO: assumes pack 1 for now
-                        self.ircCon.msg(self.bot, "XDCC INFO #1")
-                        self.ircCon.md5Conditions[self.bot].wait()
+                        # packlists are pack 1
+                        pack = self.job.pack if self.job is not None else "#1"
+                        self.ircCon.msg(self.bot, "XDCC INFO %s" % pack)
+                        self.ircCon.md5Conditions[self.bot].wait(30)
                         if self.bot in self.ircCon.md5Data:
-                            with open(self.filename, 'rb') as f:
-                                curmd5 = str(md5(f.read()).hexdigest())
-                                self.ircCon.logInfo(curmd5)
-                                self.ircCon.logInfo(self.ircCon.md5Data[self.bot])
-                                if curmd5 == self.ircCon.md5Data[self.bot]:
-                                    md5NotEqual = False
-                                    self.ircCon.lockPrint("md5sums are equal, not replacing.")
+                            curmd5 = self.ircCon.catalog.md5(self.filename)
+                            self.ircCon.logInfo(curmd5)
+                            self.ircCon.logInfo(self.ircCon.md5Data[self.bot])
+                            if curmd5 == self.ircCon.md5Data[self.bot]:
+                                md5NotEqual = False
+                                self.ircCon.lockPrint("md5sums are equal, not replacing.")
                     del self.ircCon.md5Conditions[self.bot]
                     return md5NotEqual
             else:
@@ -244,6 +1682,36 @@ class DCCThread(Thread):
         return False
 
 
+class LineFramer:
+    """
+    Cuts the bytes read from the irc socket into lines.
+    Bytes collect in a bytearray and complete lines are sliced out by offset,
+    so a flood of NAMES or MOTD replies is only scanned once. Only whole lines
+    are decoded, so a multibyte character split between two reads survives.
+    Lines may end in \\r\\n or a bare \\n.
+    """
+    def __init__(self, recvSize = 16384):
+        self.recvSize = recvSize
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Adds received bytes. Returns the lines they complete."""
+        buf = self.buffer
+        buf += data
+        lines = []
+        start = 0
+        end = buf.find(b"\n")
+        while end >= 0:
+            stop = end - 1 if end > start and buf[end - 1] == 13 else end
+            if stop > start:
+                lines.append(buf[start:stop].decode("UTF-8", "ignore"))
+            start = end + 1
+            end = buf.find(b"\n", start)
+        if start:
+            del buf[:start]
+        return lines
+
+
 class ListenerThread(Thread):
     """
     A ListenerThread blocks until it receives bytes on the irc socket.
@@ -253,14 +1721,13 @@ class ListenerThread(Thread):
         Thread.__init__(self)
         self.ircCon = ircConnection
         self.die = False
-        self.data = str()
+        self.framer = LineFramer(ircConnection.recvSize)
 
     def run(self):
         """Main parse loop receives data and parses it for requests."""
-        started = time()
         while not self.die:
             try:
-                new_data = str(self.ircCon.socket.recv(512), encoding = "UTF-8", errors = "ignore")
+                new_data = self.ircCon.socket.recv(self.framer.recvSize)
             except socket.timeout as socketerror:
                 self.reconnect("Error: Socket timout. Reconnecting.")
                 return
@@ -272,115 +1739,595 @@ class ListenerThread(Thread):
             if len(new_data) == 0:
                 self.reconnect("Error: Connection to server lost. Reconnecting.")
                 return
-            self.data += new_data
-            self.ircCon.logInfo("total:\"" + self.data + "\"")
-            if '\r\n' not in self.data:
-                continue
-            lines = self.data.split("\r\n")
-            for i in range(len(lines)-1):
-                if not match(MESSAGE_REGEX, lines[i]) or lines[i] == "":
+            for line in self.framer.feed(new_data):
+                msg = self.ircCon.handler.parse(line)
+                if msg is None:
+                    continue
+                # the lines of a bot's reply (XDCC INFO) belong together, so
+                # notices are handled here in the order they arrived
+                if msg.command == "NOTICE":
+                    self.ircCon.handler.handle(msg)
                     continue
-                pt = IRCParseThread(self.ircCon, lines[i], self)
+                pt = IRCParseThread(self.ircCon, msg, self)
                 pt.daemon = True
                 pt.start()
-            if lines[len(lines)-1] != "":
-                self.data = lines[len(lines)-1]
-            else:
-                self.data = str()
 
     def reconnect(self, msg):
         self.ircCon.printAndLogInfo(msg)
+        self.ircCon.metrics.inc("irc_reconnects_total")
         self.ircCon.connect(3)
 
 
+class WriterThread(Thread):
+    """
+    A WriterThread is the only thread writing to the irc socket.
+    It sends what the OutboundQueue lets out with sendall, so
+    lines are never cut short by a partial write.
+    """
+    def __init__(self, ircConnection):
+        Thread.__init__(self)
+        self.ircCon = ircConnection
+
+    def run(self):
+        while True:
+            data = self.ircCon.outbound.get()
+            try:
+                self.ircCon.socket.sendall(data)
+            except (socket.error, AttributeError) as e:
+                # the listener notices a dead connection and reconnects
+                self.ircCon.printAndLogInfo("send error: {0}".format(e))
+
+
 class IRCParseThread(Thread):
-    """Handles parsing incoming data from the irc socket."""
-    def __init__(self, ircConnection, data, listenerThread):
+    """Handles a message parsed from the irc socket."""
+    def __init__(self, ircConnection, msg, listenerThread):
         Thread.__init__(self)
         self.ircCon = ircConnection
-        self.data = data
+        self.msg = msg
         self.listenerThread = listenerThread
 
     def run(self):
-        self.ircCon.logInfo("\"" + self.data + "\"")
-        regex = match(MESSAGE_REGEX, self.data)
-        nickname, command, params, trailing = (regex.group(x) for x in ("nickname", "command", "params", "trailing"))
-        # check for link close
-        tmp = search(r"^ERROR :Closing Link:", self.data)
-        if tmp:
-            if self.ircCon.connectedCondition is not None:
-                with self.ircCon.connectedCondition:
-                    self.ircCon.unableToConnect = True
-                    self.ircCon.connectedCondition.notify()
-        if trailing == "Nickname is already in use.":
-            self.ircCon.nick += "_"
-            if self.ircCon.connectedCondition is not None:
-                with self.ircCon.connectedCondition:
+        self.ircCon.handler.handle(self.msg)
+
+
+class IRCMessageHandler:
+    """
+    Reacts to messages received on the irc socket.
+    Shared by the threaded and the asyncio engine so
+    both behave the same. Must not block for long.
+    Each command has its own handler in the dispatch table
+    so a line only goes through the checks for its command.
+    """
+    def __init__(self, ircConnection):
+        self.ircCon = ircConnection
+        # the names the XDCC INFO reply currently coming from each bot is about
+        self.infoNames = dict()
+        self.dispatch = {
+            "PING": self.onPing,
+            "PRIVMSG": self.onPrivmsg,
+            "NOTICE": self.onNotice,
+            "JOIN": self.onJoin,
+            "001": self.onWelcome,
+            "433": self.onNickInUse,
+            "ERROR": self.onError,
+        }
+
+    def parse(self, line):
+        """parseMessage, counted per command and timed for the metrics."""
+        start = perf_counter()
+        msg = parseMessage(line)
+        metrics = self.ircCon.metrics
+        metrics.observe("irc_parse_seconds", perf_counter() - start, PARSE_BUCKETS)
+        metrics.inc("irc_lines_received_total", command = "unparsed" if msg is None else msg.command)
+        return msg
+
+    def handle(self, msg):
+        self.ircCon.trace("\"%s\"", msg.raw)
+        handler = self.dispatch.get(msg.command)
+        if handler is not None:
+            handler(msg)
+
+    def notifyConnected(self, failed = False):
+        if not failed:
+            self.ircCon.outbound.registered()
+        if self.ircCon.connectedCondition is not None:
+            with self.ircCon.connectedCondition:
+                if failed:
                     self.ircCon.unableToConnect = True
-                    self.ircCon.connectedCondition.notify()
-        # check for PING request
-        if command == "PING" and trailing is not None:
-            if self.ircCon.connectedCondition is not None:
-                with self.ircCon.connectedCondition:
-                    self.ircCon.connectedCondition.notify()
-            send(self.ircCon, "PONG :" + trailing + "\r\n")
-        # check for welcome message
-        if params == self.ircCon.nick and search(r"Welcome to the.*" + self.ircCon.nick, trailing):
-            if self.ircCon.connectedCondition is not None:
-                with self.ircCon.connectedCondition:
-                    self.ircCon.connectedCondition.notify()
-        # check for channel join
-        if command == "JOIN" and nickname == self.ircCon.nick:
-            chan = trailing.lower()
-            chan = sub(r"[#]", "", chan)
-            if chan in self.ircCon.joinConditions:
-                with self.ircCon.joinConditions[chan]:
-                    self.ircCon.joinConditions[chan].notify()
-        if command == "PRIVMSG" and params == self.ircCon.nick:
-            if trailing == "\x01VERSION\x01":
-                self.ircCon.notice(self.ircCon, "VERSION irc.py")
-            elif search(r"\x01DCC SEND", trailing):
-                self.parseSend()
-        if command == "NOTICE" and params == self.ircCon.nick:
-            if nickname is not None and nickname in self.ircCon.cancelEvents and (trailing == "don't have a transfer" or "Transfer canceled by user" in trailing):
-                self.ircCon.cancelEvents[nickname].set()
-            if trailing is not None and search(r"\*\* You can only have .* at a time, Added you to the main queue for", trailing):
-                self.ircCon.pout(((asctime(localtime()) + " Waiting in queue for pack.\n", None),))
+                self.ircCon.connectedCondition.notify()
+
+    def onError(self, msg):
+        # check for link close
+        if msg.trailing is not None and msg.trailing.startswith("Closing Link:"):
+            self.notifyConnected(failed = True)
+
+    def onNickInUse(self, msg):
+        self.ircCon.nick += "_"
+        self.notifyConnected(failed = True)
+
+    def onPing(self, msg):
+        if msg.trailing is None:
+            return
+        self.notifyConnected()
+        send(self.ircCon, "PONG :" + msg.trailing + "\r\n")
+
+    def onWelcome(self, msg):
+        if msg.params == self.ircCon.nick:
+            self.notifyConnected()
+
+    def onJoin(self, msg):
+        if msg.nickname != self.ircCon.nick or msg.trailing is None:
+            return
+        chan = msg.trailing.lower().replace("#", "")
+        if chan in self.ircCon.joinConditions:
+            with self.ircCon.joinConditions[chan]:
+                self.ircCon.joinConditions[chan].notify()
+
+    def onPrivmsg(self, msg):
+        if msg.params != self.ircCon.nick or msg.trailing is None:
+            return
+        if msg.trailing == "\x01VERSION\x01":
+            self.ircCon.notice(msg.nickname, "VERSION irc.py")
+        elif msg.trailing.startswith("\x01DCC SEND"):
+            self.parseSend(msg)
+        elif msg.trailing.startswith("\x01DCC ACCEPT"):
+            self.parseAccept(msg)
+
+    def onNotice(self, msg):
+        nickname, trailing = msg.nickname, msg.trailing
+        if msg.params != self.ircCon.nick or trailing is None:
+            return
+        if nickname is not None and nickname in self.ircCon.cancelEvents and (trailing == "don't have a transfer" or "Transfer canceled by user" in trailing):
+            self.ircCon.cancelEvents[nickname].set()
+            return
+        queued = QUEUED_REGEX.search(trailing)
+        if queued:
+            if nickname is None:
+                return
+            if queued.group(1):
+                self.ircCon.scheduler.setBotLimit(nickname, int(queued.group(1)))
+            position = int(queued.group(3)) if queued.group(3) else None
+            job = self.ircCon.scheduler.queued(nickname, queued.group(2), position)
+            self.ircCon.pout(((asctime(localtime()) + " Waiting in queue for " + (job.name if job else "pack")
+                + (" at position %d" % position if position else "") + ".\n", None),))
+            return
+        queue = QUEUE_REGEX.search(trailing)
+        if queue and nickname is not None:
+            remaining = None
+            if queue.group(4):
+                remaining = int(queue.group(4)) * 3600 + int(queue.group(5)) * 60
+            self.ircCon.scheduler.queued(nickname, queue.group(1), int(queue.group(2)), int(queue.group(3)), remaining)
+        elif REJECTED_REGEX.search(trailing):
+            self.ircCon.scheduler.rejected(nickname)
+        elif nickname is not None:
+            info = INFO_REGEX.match(trailing)
+            if info:
+                self.parseInfo(nickname, info.group(1), info.group(2))
+
+    def parseInfo(self, bot, key, value):
+        """Collects the file names and hashes of an XDCC INFO reply."""
+        if key == "Filename":
+            self.infoNames[bot] = [value]
+            return
+        if key == "Sendname":
+            self.infoNames.setdefault(bot, []).append(value)
+            return
+        for name in self.infoNames.get(bot, ()):
+            self.ircCon.fileInfo.setdefault(name, dict())[key] = value
+            if name in self.ircCon.infoEvents:
+                self.ircCon.infoEvents[name].set()
         # recv md5 data for a file
-        tmp = search(r":([^!^:]+)![^!]+NOTICE " + self.ircCon.nick + r" : md5sum +([a-f0-9]+)", self.data)
-        if tmp:
+        if key == "md5sum":
             self.ircCon.logInfo("Got md5 sum")
-            bot = tmp.group(1)
-            md5sum = tmp.group(2)
             if bot in self.ircCon.md5Conditions:
                 self.ircCon.logInfo("bot in md5Conditions")
                 with self.ircCon.md5Conditions[bot]:
-                    self.ircCon.md5Data[bot] = md5sum
+                    self.ircCon.md5Data[bot] = value
                     self.ircCon.md5Conditions[bot].notify_all()
 
-    def parseSend(self):
-        """Parse self.data for a valid DCC SEND request."""
-        try:
-            (sender, filename, ip, port, filesize) = [t(s) for t,s in zip((str,str,int,int,int),
-            search(r":([^!^:]+)![^!]+DCC SEND \"*([^\"]+)\"* :*(\d+) (\d+) (\d+)", self.data).groups())]
-        except:
+    def parseSend(self, msg):
+        """Parse a message for a valid DCC SEND request."""
+        offer = parseDCCSend(msg.trailing)
+        if offer is None or msg.nickname is None:
             logging.warning("Malformed DCC SEND request, ignoring...")
             return
+        (filename, ip, port, filesize) = offer
         # unpack the ip to get a proper hostname
         host = socket.inet_ntoa(pack("!I", ip))
-        dcc = DCCThread(filename, host, port, filesize, self.ircCon, sender)
-        dcc.daemon = True
-        dcc.start() # start the thread
-        newfile = dcc.join() # wait for the thread to finish
-        # notify anyone waiting on the packlistCondition for this bot
-        if sender in self.ircCon.packlistConditions:
-            with self.ircCon.packlistConditions[sender]:
-                self.ircCon.packlists[sender] = filename
-                self.ircCon.packlistConditions[sender].notify_all()
-        # notify anyone waiting on the responseCondition for this bot
-        if sender in self.ircCon.responseEvents:
-            self.ircCon.responseEvents[sender].set()
+        dcc = DCCThread(filename, host, port, filesize, self.ircCon, msg.nickname)
+        dcc.job = self.ircCon.scheduler.match(msg.nickname, filename, filesize)
+        if dcc.job is None:
+            dcc.sink = self.ircCon.packlistReceivers.pop(msg.nickname, None)
+        self.ircCon.runTransfer(dcc)
 
+    def parseAccept(self, msg):
+        """Hands the position of a DCC ACCEPT to the transfer waiting on it."""
+        regex = DCC_ACCEPT_REGEX.search(msg.trailing)
+        if regex is None:
+            logging.warning("Malformed DCC ACCEPT, ignoring...")
+            return
+        key = (msg.nickname, int(regex.group(2)))
+        if key in self.ircCon.resumeEvents:
+            self.ircCon.resumeOffsets[key] = int(regex.group(3))
+            self.ircCon.resumeEvents[key].set()
+
+
+class DownloadJob:
+    """
+    A pack waiting for, or going through, a DownloadScheduler.
+    bot and pack are where it is requested from next, out of sources.
+    """
+    def __init__(self, bot, pack, name, size = 0, sources = None):
+        self.bot = bot
+        self.pack = pack
+        self.name = name
+        self.size = size
+        # the bot whose packlist it was found in
+        self.origin = bot
+        # stores the pack number of each bot listing the file
+        self.sources = {bot: pack}
+        if sources:
+            self.sources.update(sources)
+        # bots a transfer of it failed from
+        self.failed = set()
+        self.attempts = 0
+        # set once a DCC offer has been matched to this job
+        self.offered = False
+        # asked for in an XDCC BATCH with other packs
+        self.batched = False
+        # our place in the bot's queue, the queue's length and the time it says is left
+        self.position = None
+        self.queueTotal = None
+        self.remaining = None
+        self.queuedAt = None
+        self.ok = False
+        self.done = Event()
+        # when the last request went out, its first byte came in and the job ended
+        self.requested = None
+        self.firstByte = None
+        self.finished = None
+
+
+class DownloadScheduler(Thread):
+    """
+    A DownloadScheduler owns the queue of packs to download from all bots.
+    It keeps up to maxTransfers requests going at once and at most
+    botTransfers (plus pipeline) per bot, and hands the next job to whichever
+    slot frees first.
+    A bot's limit is lowered when it tells us "You can only have N at a time".
+    A pack listed by several bots goes to the free one with the best
+    BotStats.expected time, and to the next one if a transfer fails.
+    Requests a bot has queued don't count against the limits, up to
+    queueDepth more are lined up behind them. A queued request is moved
+    when another bot is expected to be done queueMargin seconds sooner.
+    With pipeline, that many requests more than its limit go to a bot, so the
+    next pack is queued before the last one is through. A bot with a free slot
+    sends it right away, and its offer is taken, the bot wouldn't wait. With
+    batch, several packs for one bot are asked for in a single XDCC BATCH until
+    the bot turns out not to know it: none of them answered within batchTimeout
+    seconds.
+    """
+    def __init__(self, ircConnection, maxTransfers = 4, botTransfers = 1, retries = 2, queueDepth = 2, queueMargin = 30,
+            pipeline = 0, batch = False, batchTimeout = 30):
+        Thread.__init__(self)
+        self.ircCon = ircConnection
+        self.maxTransfers = maxTransfers
+        self.botTransfers = botTransfers
+        self.retries = retries
+        self.queueDepth = queueDepth
+        self.queueMargin = queueMargin
+        self.pipeline = pipeline
+        self.batch = batch
+        self.batchTimeout = batchTimeout
+        # stores whether each bot understood XDCC BATCH, once we know
+        self.batchSupport = dict()
+        self.botLimits = dict()
+        self.queue = deque()
+        # bot -> jobs that have been requested and not finished yet
+        self.active = dict()
+        self.running = 0
+        # bots whose jobs wait, e.g. while their packlist is being sent
+        self.held = set()
+        self.condition = Condition(Lock())
+        self.daemon = True
+        self.start()
+
+    def add(self, bot, pack, name, size = 0, sources = None):
+        """Queues a pack. A file that is already queued just gains the new sources."""
+        with self.condition:
+            for job in self.jobs():
+                if job.name == name:
+                    job.sources.setdefault(bot, pack)
+                    if sources:
+                        for source, number in sources.items():
+                            job.sources.setdefault(source, number)
+                    self.condition.notify_all()
+                    return job
+            job = DownloadJob(bot, pack, name, size, sources)
+            self.queue.append(job)
+            self.condition.notify_all()
+        return job
+
+    def jobs(self):
+        """Every queued and active job. Call with the condition held."""
+        for job in self.queue:
+            yield job
+        for jobs in self.active.values():
+            for job in jobs:
+                yield job
+
+    def run(self):
+        while True:
+            with self.condition:
+                jobs = self.nextJobs()
+                while not jobs:
+                    self.condition.wait()
+                    jobs = self.nextJobs()
+            bot = jobs[0].bot
+            for job in jobs:
+                job.attempts += 1
+                job.requested = time()
+                job.firstByte = None
+                job.batched = len(jobs) > 1
+                self.ircCon.pout((("Requesting pack ", gui.cyanText), (job.pack, gui.yellowText), (" " + job.name + " from ", None), (bot, gui.magentaText), ("\n", None)))
+            if len(jobs) > 1:
+                self.ircCon.msg(bot, "XDCC BATCH %s" % packRanges([job.pack for job in jobs]))
+            else:
+                self.ircCon.msg(bot, "XDCC SEND %s" % jobs[0].pack)
+
+    def nextJobs(self):
+        """
+        The next job to request and the others that go to the same bot
+        with it in one XDCC BATCH. Call with the condition held.
+        """
+        job = self.nextJob()
+        if job is None:
+            return []
+        jobs = [job]
+        self.take(job)
+        if not self.batch or self.batchSupport.get(job.bot) is False:
+            return jobs
+        for other in list(self.queue):
+            if self.full():
+                break
+            if job.bot in other.sources and self.pickBot(other) == job.bot:
+                self.queue.remove(other)
+                other.bot, other.pack = job.bot, other.sources[job.bot]
+                self.take(other)
+                jobs.append(other)
+        return jobs
+
+    def take(self, job):
+        self.active.setdefault(job.bot, []).append(job)
+        self.running += 1
+
+    def full(self):
+        """Whether maxTransfers requests are out, not counting queued ones. Call with the condition held."""
+        return self.running - sum(self.waiting(bot) for bot in self.active) >= self.maxTransfers
+
+    def nextJob(self):
+        """The first queued job with a free slot, set to go to the best bot. Call with the condition held."""
+        if self.full():
+            return None
+        for job in self.queue:
+            bot = self.pickBot(job)
+            if bot is not None:
+                self.queue.remove(job)
+                job.bot, job.pack = bot, job.sources[bot]
+                return job
+        return None
+
+    def pickBot(self, job):
+        """The free source of job expected to finish it first, bots that failed it last."""
+        free = [bot for bot in job.sources if self.free(bot)]
+        if not free:
+            return None
+        stats = self.ircCon.botStats
+        return min(free, key = lambda bot: (bot in job.failed, stats.expected(bot, job.size)))
+
+    def free(self, bot):
+        """Whether another request may go to bot. Call with the condition held."""
+        if bot in self.held or self.waiting(bot) >= self.queueDepth:
+            return False
+        return len(self.active.get(bot, ())) - self.waiting(bot) < self.limit(bot) + self.pipeline
+
+    def limit(self, bot):
+        return self.botLimits.get(bot, self.botTransfers)
+
+    def waiting(self, bot):
+        """Our requests waiting in the bot's queue. Call with the condition held."""
+        return sum(1 for job in self.active.get(bot, ()) if job.position is not None)
+
+    def queued(self, bot, name, position, total = None, remaining = None):
+        """Notes where a request of ours waits in the bot's queue. Returns its job, if known."""
+        with self.condition:
+            job = self.find(bot, name)
+            if job is None:
+                return None
+            if job.position is None:
+                job.queuedAt = time()
+            if job.batched:
+                self.batchSupport[bot] = True
+            # iroffer doesn't always say, first in line is the best guess
+            job.position = position or 1
+            job.queueTotal = total
+            job.remaining = remaining
+            self.condition.notify_all()
+            return job
+
+    def queuedBots(self):
+        with self.condition:
+            return [bot for bot in self.active if self.waiting(bot)]
+
+    def rebalance(self):
+        """
+        Takes requests out of bot queues that are expected to take longer than
+        another bot listing the same pack, and queues them again.
+        Returns (bot, pack) of each one to be removed from its bot's queue.
+        """
+        stats = self.ircCon.botStats
+        moved = []
+        with self.condition:
+            for bot, jobs in self.active.items():
+                for job in [job for job in jobs if job.position is not None and not job.offered]:
+                    left = job.remaining or job.position * stats.expected(bot, job.size)
+                    others = [other for other in job.sources if other != bot and other not in job.failed and self.free(other)]
+                    if not others or min(stats.expected(other, job.size) for other in others) + self.queueMargin >= left:
+                        continue
+                    jobs.remove(job)
+                    self.running -= 1
+                    moved.append((bot, job.pack))
+                    # passed over rather than failed, but it goes last for this job all the same
+                    job.failed.add(bot)
+                    job.attempts -= 1
+                    job.position = None
+                    self.queue.appendleft(job)
+            if moved:
+                self.condition.notify_all()
+        return moved
+
+    def hold(self, bot):
+        with self.condition:
+            self.held.add(bot)
+
+    def release(self, bot):
+        with self.condition:
+            self.held.discard(bot)
+            self.condition.notify_all()
+
+    def setBotLimit(self, bot, limit):
+        with self.condition:
+            self.botLimits[bot] = max(1, min(limit, self.botTransfers))
+            self.condition.notify_all()
+
+    def match(self, bot, filename, filesize = None):
+        """Finds the requested job a DCC offer belongs to."""
+        with self.condition:
+            job = self.find(bot, filename, filesize)
+            if job is not None:
+                job.offered = True
+                job.position = None
+                if job.batched:
+                    self.batchSupport[bot] = True
+            return job
+
+    def find(self, bot, filename, filesize = None):
+        """
+        The requested job filename belongs to. Call with the condition held.
+        Bots may swap spaces for underscores, so names are compared loosely,
+        then by the size the packlist gave. A bot's only outstanding request
+        takes any name, unless its packlist is on the way.
+        """
+        waiting = [job for job in self.active.get(bot, ()) if not job.offered]
+        if filename is not None:
+            key = filename.replace(" ", "_").lower()
+            for job in waiting:
+                if job.name == filename or job.name.replace(" ", "_").lower() == key:
+                    return job
+        if filesize is not None:
+            # packlists round sizes down to a tenth of the unit at worst
+            sized = [job for job in waiting if job.size <= filesize < job.size * 1.1 + 1024]
+            if len(sized) == 1 and bot not in self.held:
+                return sized[0]
+        if len(waiting) != 1 or bot in self.held:
+            return None
+        return waiting[0]
+
+    def unbatch(self, bot, jobs):
+        """The bot doesn't know XDCC BATCH, jobs are asked for one by one. Call with the condition held."""
+        self.batchSupport[bot] = False
+        self.ircCon.logInfo(bot + " doesn't support XDCC BATCH.")
+        # reversed so they end up at the front in the order they were asked for
+        for job in reversed(jobs):
+            self.active[bot].remove(job)
+            self.running -= 1
+            job.attempts -= 1
+            job.batched = False
+            self.queue.appendleft(job)
+        self.condition.notify_all()
+
+    def expireBatches(self):
+        """Asks again, pack by pack, for batches a bot never answered."""
+        with self.condition:
+            for bot, jobs in list(self.active.items()):
+                if self.batchSupport.get(bot) is not None:
+                    continue
+                stale = [job for job in jobs if job.batched and not job.offered and job.position is None
+                    and time() - job.requested > self.batchTimeout]
+                if stale:
+                    self.unbatch(bot, stale)
+
+    def rejected(self, bot):
+        """The bot refused our oldest outstanding request, another bot may still have the pack."""
+        with self.condition:
+            waiting = [job for job in self.active.get(bot, ()) if not job.offered]
+            if waiting:
+                waiting[0].sources.pop(bot, None)
+                if waiting[0].batched:
+                    # a bot that doesn't know XDCC BATCH wouldn't look at the packs
+                    self.batchSupport[bot] = True
+        if waiting:
+            self.finished(waiting[0], False, retry = bool(waiting[0].sources))
+
+    def finished(self, job, ok, retry = True):
+        with self.condition:
+            self.active[job.bot].remove(job)
+            self.running -= 1
+            job.position = None
+            if not ok:
+                job.failed.add(job.bot)
+            # every other source gets a go on top of the retries
+            if not ok and retry and job.attempts <= self.retries + len(job.sources) - 1:
+                job.offered = False
+                self.queue.append(job)
+            else:
+                job.ok = ok
+                job.finished = time()
+                job.done.set()
+            self.condition.notify_all()
+
+    def pending(self, bot):
+        """
+        Whether anything is being asked of bot, or a job found in its packlist
+        hasn't finished. Call with the condition held.
+        """
+        return bool(self.active.get(bot)) or any(job.origin == bot for job in self.jobs())
+
+    def busy(self, bot):
+        """Whether any request to bot hasn't finished."""
+        with self.condition:
+            return bool(self.active.get(bot))
+
+    def waitBot(self, bot):
+        """Blocks until every job for bot has finished."""
+        with self.condition:
+            while self.pending(bot):
+                self.condition.wait()
+
+
+class QueueMonitor(Thread):
+    """
+    Every interval seconds asks each bot that has requests of ours queued
+    where they stand (XDCC QUEUE), and takes the ones another bot would
+    deliver sooner out of the queue again (XDCC REMOVE). Batches that
+    went unanswered are split up.
+    """
+    def __init__(self, ircConnection, interval = 60):
+        Thread.__init__(self)
+        self.ircCon = ircConnection
+        self.interval = interval
+        self.daemon = True
+
+    def run(self):
+        scheduler = self.ircCon.scheduler
+        while True:
+            sleep(self.interval)
+            scheduler.expireBatches()
+            for bot, number in scheduler.rebalance():
+                self.ircCon.pout((("Leaving the queue of ", None), (bot, gui.magentaText), (" for pack ", None), (number, gui.yellowText), (", another bot is faster.\n", None)))
+                self.ircCon.msg(bot, "XDCC REMOVE %s" % number)
+            for bot in scheduler.queuedBots():
+                self.ircCon.msg(bot, "XDCC QUEUE")
 
 class PacklistParsingThread(Thread):
     """
@@ -394,6 +2341,7 @@ class PacklistParsingThread(Thread):
         self.ircCon = ircConnection
         self.die = False
         self.series = series
+        self.watchlist = Watchlist(series)
         self.f = None
         self.sleepTime = sleepTime
         self.repeat = repeat
@@ -404,14 +2352,26 @@ class PacklistParsingThread(Thread):
     def run(self):
         while not self.die:
             startTime = time()
-            self.ircCon.msg(self.bot, "XDCC CANCEL")
-            if not self.bot in self.ircCon.cancelEvents:
-                self.ircCon.cancelEvents[self.bot] = Event()
-            self.ircCon.cancelEvents[self.bot].wait(2)
-            del self.ircCon.cancelEvents[self.bot]
+            self.clearBot()
             self.ircCon.pout(((asctime(localtime()), gui.yellowText), (" - Checking ", None), (self.bot, gui.magentaText), (" for packs.\n", None)))
-            packlistArrived = self.waitOnPacklist()
-            self.parseFile()
+            self.jobs = []
+            if self.ircCon.memoryPacklists:
+                packlistArrived = self.streamPacklist()
+            else:
+                # no other pack is asked of the bot while its packlist comes,
+                # and the matches are requested together once all are queued
+                self.ircCon.scheduler.hold(self.bot)
+                try:
+                    packlistArrived = self.waitOnPacklist()
+                    self.parseFile()
+                finally:
+                    self.ircCon.scheduler.release(self.bot)
+            # the next packlist request would be taken for one of our packs
+            self.ircCon.scheduler.waitBot(self.bot)
+            # packs that didn't download are looked at again next time
+            for job in self.jobs:
+                if not job.ok:
+                    self.ircCon.packlistSnapshots[self.bot].forget(job.name)
             self.ircCon.pout((("Finished checking ", None), (self.bot, gui.magentaText), (" for packs.\n", None)))
             timeShouldSleep = self.sleepTime - (time() - startTime)
             if not self.repeat:
@@ -419,6 +2379,26 @@ class PacklistParsingThread(Thread):
             elif packlistArrived and timeShouldSleep > 0:
                 sleep(timeShouldSleep)
 
+    def clearBot(self):
+        """
+        Makes sure the bot isn't sending us anything before its packlist is
+        asked for. Packs other polls found may be coming from it, those are
+        waited for rather than cancelled.
+        """
+        scheduler = self.ircCon.scheduler
+        scheduler.hold(self.bot)
+        try:
+            if scheduler.busy(self.bot):
+                scheduler.waitBot(self.bot)
+                return
+            self.ircCon.msg(self.bot, "XDCC CANCEL")
+            if not self.bot in self.ircCon.cancelEvents:
+                self.ircCon.cancelEvents[self.bot] = Event()
+            self.ircCon.cancelEvents[self.bot].wait(2)
+            del self.ircCon.cancelEvents[self.bot]
+        finally:
+            scheduler.release(self.bot)
+
     def waitOnPacklist(self):
             self.ircCon.lastRequestedPack[self.bot] = None
             while self.ircCon.lastRequestedPack[self.bot] == None:
@@ -442,32 +2422,72 @@ class PacklistParsingThread(Thread):
     def parseFile(self):
         with open(self.filename, mode = "r", encoding = encoding, errors = "ignore") as f:
             lines = f.read().splitlines()
-        for series in self.series:
-            for line in lines:
-                try:
-                    (self.pack, self.dls, self.size, self.name) = [t(s) for t,s in zip((str,int,str,str),
-                    search(r"(\S+) +(\d+)x \[([^\[^\]]+)\] ([^\"^\n]+)", line).groups())]
-                    if not search(series, self.name):
-                        raise Exception("regex failure")
-                    self.checkCandidate()
-                except:
-                    continue
+        records = [record for record in map(parsePackLine, lines) if record is not None]
+        new, removed, changed = self.snapshot().diff(records, self.watchlist.patterns)
+        index = self.ircCon.packIndex
+        for record in records:
+            index.add(self.bot, record)
+        for record in removed:
+            index.remove(self.bot, record)
+        self.ircCon.logInfo("%s: %d new, %d removed, %d changed packs" % (self.bot, len(new), len(removed), len(changed)))
+        for record, i in self.watchlist.matches(new + changed):
+            self.candidate(record, i)
+
+    def streamPacklist(self):
+        """
+        Has the packlist sent into a PacklistReceiver and matches
+        packs while it arrives. Returns False if it didn't arrive in full.
+        """
+        snapshot = self.snapshot()
+        # packs matched early are requested once the packlist is through
+        self.ircCon.scheduler.hold(self.bot)
+        try:
+            return self.receivePacklist(snapshot)
+        finally:
+            self.ircCon.scheduler.release(self.bot)
+
+    def receivePacklist(self, snapshot):
+        while True:
+            receiver = PacklistReceiver()
+            self.ircCon.packlistReceivers[self.bot] = receiver
+            self.ircCon.msg(self.bot, "XDCC SEND #1")
+            snapshot.begin(self.watchlist.patterns)
+            counts = {"new": 0, "changed": 0, None: 0}
+            for record in receiver:
+                self.ircCon.packIndex.add(self.bot, record)
+                status = snapshot.add(record)
+                counts[status] += 1
+                if status is not None:
+                    i = self.watchlist.match(record.name)
+                    if i is not None:
+                        self.candidate(record, i)
+            removed = snapshot.end(receiver.complete)
+            for record in removed:
+                self.ircCon.packIndex.remove(self.bot, record)
+            if receiver.received == 0:
+                # the connection failed, ask again
+                continue
+            self.ircCon.logInfo("%s: %d new, %d removed, %d changed packs" % (self.bot, counts["new"], len(removed), counts["changed"]))
+            return receiver.complete
+
+    def snapshot(self):
+        if self.bot not in self.ircCon.packlistSnapshots:
+            self.ircCon.packlistSnapshots[self.bot] = PacklistSnapshot()
+        return self.ircCon.packlistSnapshots[self.bot]
+
+    def candidate(self, record, i):
+        (self.pack, self.dls, self.size, self.name) = (record.pack, record.dls, record.size, record.name)
+        self.pattern = self.watchlist.patterns[i]
+        self.sources = self.ircCon.packIndex.sources(record)
+        self.checkCandidate()
 
     def checkCandidate(self):
-        self.ircCon.logInfo("candidate: " + self.name)
-        filesystemLock.acquire()
-        if not isfile(self.name):
-            filesystemLock.release()
-            self.ircCon.pout((("Requesting pack ", gui.cyanText), (self.pack, gui.yellowText), (" " + self.name + "\n", None)))
-            self.ircCon.lastRequestedPack[self.bot] = None
-            while self.ircCon.lastRequestedPack[self.bot] == None:
-                self.ircCon.responseEvents[self.bot] = Event()
-                self.ircCon.lastRequestedPack[self.bot] = self.pack
-                self.ircCon.msg(self.bot, "XDCC SEND %s" % self.pack)
-                self.ircCon.responseEvents[self.bot].wait()
-                del self.ircCon.responseEvents[self.bot]
+        self.ircCon.logInfo("candidate: " + self.name + " (matched " + self.pattern + ")")
+        entry = self.ircCon.catalog.get(self.name)
+        # packlist sizes are rounded down, the catalog knows which files a transfer left unfinished
+        if entry is None or entry.state == FileCatalog.PARTIAL or entry.size < max(packSizeBytes(self.size), entry.expected or 0):
+            self.jobs.append(self.ircCon.scheduler.add(self.bot, self.pack, self.name, packSizeBytes(self.size), self.sources))
         else:
-            filesystemLock.release()
             self.ircCon.logInfo("File already exists.")
 
 
@@ -480,9 +2500,52 @@ class IRCConnection:
     network: IP addr. of irc network
     nick: IRC nickname used to authenticate.
     gui: Boolean value enabling/disabling the GUI.
-    maxRate: Max allowable download speed in KiB/s.
+    maxRate: Max allowable download speed in KiB/s, shared by all transfers.
+        May be a BandwidthSchedule.
+    botRate: Max download speed from a single bot in KiB/s.
+    transferRate: Max speed of a single transfer in KiB/s.
+    engine: "thread" (default) or "asyncio". The asyncio engine runs the
+        irc socket, message dispatch and DCC transfers on one event loop
+        instead of a thread per line and per transfer.
+    chunkSize: Bytes read from a DCC socket per recv.
+    recvSize: Bytes read from the irc socket per recv.
+    zeroCopy: Splice DCC data straight from the socket to disk (Linux only).
+        Ignored while transfers are rate limited.
+    memoryPacklists: Receive packlists into memory and match packs while they
+        arrive instead of saving them as .txt files first.
+    verify: Hash transfers as they arrive and check them against the bot's
+        XDCC INFO and the CRC32 tag in the filename.
+    maxTransfers: Packs downloaded at once across all bots.
+    botTransfers: Packs downloaded at once from a single bot, pipeline aside.
+    floodBurst, floodInterval: The server's flood limit. floodBurst lines may be
+        sent at once, after that one every floodInterval seconds.
+    metricsFile: Write the metrics in the Prometheus text format to this file
+        every 10 seconds.
+    metricsPort: Serve the metrics at http://127.0.0.1:metricsPort/metrics.
+    writeBuffers, writeBufferSize: Transfers are written to disk by a thread of
+        their own through this many buffers of this many bytes.
+        0 writes on the receiving thread.
+    progressInterval: Seconds between updates of the transfer status line.
+    stallRate, stallFraction, stallTime: A transfer slower than stallRate KiB/s
+        and stallFraction of the bot's average for stallTime seconds is
+        cancelled and asked for again. stallTime = 0 never cancels.
+    dccTimeout: Seconds a DCC connection may go without any data.
+    queueDepth: Requests lined up in a bot's queue behind those it already queued.
+    queueInterval: Seconds between XDCC QUEUE polls of bots that queued us.
+    pipeline: Requests sent to a bot beyond botTransfers, so it has the next
+        pack lined up in its queue. A bot with a free slot sends it right away,
+        so up to botTransfers + pipeline transfers may run from one bot. Off by default.
+    batch: Ask for several packs from a bot in one XDCC BATCH, as long as
+        the bot understands it. Not every bot does, so it is off by default.
     """
-    def __init__(self, network, nick, gui = False, maxRate = 0):
+    def __init__(self, network, nick, gui = False, maxRate = 0, engine = "thread", chunkSize = 256 * 1024,
+            recvSize = 16384, zeroCopy = False, memoryPacklists = False, verify = False, maxTransfers = 4, botTransfers = 1, botRate = 0, transferRate = 0,
+            floodBurst = 5, floodInterval = 2.0, metricsFile = None, metricsPort = None, progressInterval = 1.0,
+            writeBuffers = 4, writeBufferSize = 1024 * 1024, stallRate = 1, stallFraction = 0.1, stallTime = 60, dccTimeout = 60,
+            queueDepth = 2, queueInterval = 60, pipeline = 0, batch = False):
+        # before anything is opened or started
+        if engine not in ("thread", "asyncio"):
+            raise ValueError("Unknown engine: {0}".format(engine))
         port_regex = search(r":([0-9]+)\Z", network)
         if port_regex:
             port_string = port_regex.group(1)
@@ -500,23 +2563,70 @@ class IRCConnection:
             print("No curses module detected. Install curses or run with 'gui = False'.")
         else:
             self.gui = None
-        if maxRate > 0:
-            self.bucket = TokenBucket(4, 4096 / 1024 / (maxRate / 4), 4, gainAmmount = 4)
+        self.chunkSize = chunkSize
+        self.recvSize = recvSize
+        self.zeroCopy = zeroCopy
+        self.memoryPacklists = memoryPacklists
+        self.verify = verify
+        self.writeBuffers = writeBuffers
+        self.writeBufferSize = writeBufferSize
+        self.dccTimeout = dccTimeout
+        self.catalog = openCatalog()
+        self.botStats = BotStats(self.catalog.filename)
+        self.packIndex = PackIndex()
+        # stores what XDCC INFO told us about each file name
+        self.fileInfo = dict()
+        self.infoEvents = dict()
+        self.limiter = None
+        if maxRate:
+            self.limiter = RateLimiter(maxRate)
+        self.botRate = botRate
+        self.transferRate = transferRate
+        # stores the RateLimiter shared by transfers from each bot
+        self.botLimiters = dict()
         self.lastRequestedPack = dict()
         # stores the filenames of the packlists for each bot
         # assuming bot names are unique and, on an irc server, they are
         self.packlists = dict()
+        # stores the PacklistSnapshot of each bot's last poll
+        self.packlistSnapshots = dict()
+        # stores the PacklistReceiver waiting for each bot's packlist
+        self.packlistReceivers = dict()
         # stores packlist cv's for each bot
         self.packlistConditions = dict()
         # listens for md5 info
         self.md5Conditions = dict()
         self.md5Data = dict()
-        # stores response events for each bot
-        self.responseEvents = dict()
         # stores dcc cancel events for each bot
         self.cancelEvents = dict()
         # stores join cv's for each channel
         self.joinConditions = dict()
+        # stores DCC ACCEPT events and offsets for each (bot, port)
+        self.resumeEvents = dict()
+        self.resumeOffsets = dict()
+        self.handler = IRCMessageHandler(self)
+        self.scheduler = DownloadScheduler(self, maxTransfers, botTransfers, queueDepth = queueDepth,
+            pipeline = pipeline, batch = batch)
+        QueueMonitor(self, queueInterval).start()
+        self.socket = None
+        self.outbound = OutboundQueue(floodBurst, floodInterval)
+        self.metrics = Metrics()
+        self.metrics.collect(self.collectMetrics)
+        if metricsFile is not None:
+            MetricsWriter(self.metrics, metricsFile).start()
+        if metricsPort is not None:
+            serveMetrics(self.metrics, metricsPort)
+        self.stalls = StallMonitor(self, stallRate, stallFraction, stallTime)
+        self.progress = ProgressReporter(self, progressInterval, monitor = self.stalls)
+        self.progress.start()
+        if engine == "asyncio":
+            import ircasync
+            self.engine = ircasync.AsyncioEngine(self)
+        else:
+            self.engine = None
+            self.writerThread = WriterThread(self)
+            self.writerThread.daemon = True
+            self.writerThread.start()
         self.connect()
 
     def initializeGUI(self):
@@ -533,18 +2643,19 @@ class IRCConnection:
                 if timeout > 0:
                     sleep(timeout)
                 self.connectedCondition = Condition(Lock())
+                self.outbound.reset()
                 self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.settimeout(300)
+                # a server that doesn't answer is given up on sooner than a quiet one
+                self.socket.settimeout(30)
                 self.socket.connect((self.host, self.port))
-                # supply the standard nick and user info to the server
-                send(self, "NICK %s\r\n" % self.nick)
-                send(self, "USER %s %s * :%s\r\n"
-                    % (self.ident, self.host, self.realname))
+                self.socket.settimeout(300)
                 self.unableToConnect = False
                 with self.connectedCondition:
-                    self.listenerThread = ListenerThread(self)
-                    self.listenerThread.daemon = True
-                    self.listenerThread.start()
+                    self.startListener()
+                    # supply the standard nick and user info to the server
+                    send(self, "NICK %s\r\n" % self.nick)
+                    send(self, "USER %s %s * :%s\r\n"
+                        % (self.ident, self.host, self.realname))
                     self.connectedCondition.wait()
                 self.connectedCondition = None
                 if self.unableToConnect:
@@ -556,25 +2667,88 @@ class IRCConnection:
             except Exception as err:
                 self.printAndLogInfo("error: {0}".format(err))
 
-    def catchSend(self, string):
-        try:
-            send(self, string)
-        except Exception as e:
-            self.printAndLogInfo("catchSend() error: {0}".format(e))
-            self.connect()
+    def startListener(self):
+        if self.engine is not None:
+            self.engine.listen(self.socket)
+        else:
+            self.listenerThread = ListenerThread(self)
+            self.listenerThread.daemon = True
+            self.listenerThread.start()
+
+    def limiterFor(self, bot):
+        """A RateLimiter for a new transfer from bot, None if nothing is limited."""
+        if self.limiter is None and not self.botRate and not self.transferRate:
+            return None
+        parent = self.limiter
+        if self.botRate:
+            if bot not in self.botLimiters:
+                self.botLimiters[bot] = RateLimiter(self.botRate, parent)
+            parent = self.botLimiters[bot]
+        return RateLimiter(self.transferRate, parent)
+
+    def collectMetrics(self, metrics):
+        metrics.set("irc_send_queue_depth", len(self.outbound.lines))
+        metrics.set("xdcc_queued_jobs", len(self.scheduler.queue))
+        metrics.set("xdcc_bot_queued_requests", sum(1 for jobs in list(self.scheduler.active.values())
+            for job in list(jobs) if job.position is not None))
+
+    def runTransfer(self, dcc):
+        """
+        Receives the file offered by a DCC SEND.
+        Blocks the calling parse thread unless the asyncio engine is used.
+        """
+        self.metrics.add("xdcc_active_transfers", 1)
+        self.progress.add(dcc)
+        if self.engine is not None:
+            self.engine.startTransfer(dcc)
+            return
+        dcc.daemon = True
+        dcc.start() # start the thread
+        dcc.join() # wait for the thread to finish
+        self.transferFinished(dcc)
+
+    def transferFinished(self, dcc):
+        dcc.countBytes()
+        self.progress.remove(dcc)
+        self.metrics.add("xdcc_active_transfers", -1)
+        self.metrics.observe("xdcc_transfer_seconds", time() - dcc.started, TRANSFER_BUCKETS,
+            outcome = "complete" if dcc.done else "stalled" if dcc.stalled else "failed")
+        job = dcc.job
+        if job is not None:
+            if dcc.done and job.firstByte is not None and time() > job.firstByte:
+                self.botStats.record(dcc.bot, True, (dcc.bytesReceived - dcc.offset) / (time() - job.firstByte),
+                    job.firstByte - job.requested)
+            else:
+                self.botStats.record(dcc.bot, dcc.done)
+        if dcc.claimed:
+            self.catalog.release(dcc.filename)
+        if dcc.sink is not None:
+            dcc.sink.close(dcc.done)
+            return
+        if dcc.job is not None:
+            self.scheduler.finished(dcc.job, dcc.done)
+            return
+        # notify anyone waiting on the packlistCondition for this bot
+        if dcc.bot in self.packlistConditions:
+            with self.packlistConditions[dcc.bot]:
+                self.packlists[dcc.bot] = dcc.filename
+                self.packlistConditions[dcc.bot].notify_all()
 
     def msg(self, who, what):
-        self.catchSend("PRIVMSG %s :%s\r\n" % (who, what))
+        send(self, "PRIVMSG %s :%s\r\n" % (who, what))
+
+    def ctcp(self, who, what):
+        send(self, "PRIVMSG %s :\x01%s\x01\r\n" % (who, what))
 
     def notice(self, who, what):
-        self.catchSend("NOTICE %s :\x01%s\x01\r\n" % (who, what))
+        send(self, "NOTICE %s :\x01%s\x01\r\n" % (who, what))
 
     def join(self, chan):
         chan = sub(r"[#]", "", chan)
         chan = chan.lower()
         self.joinConditions[chan] = Condition(Lock())
         with self.joinConditions[chan]:
-            self.catchSend("JOIN #%s\r\n" % chan)
+            send(self, "JOIN #%s\r\n" % chan)
             self.joinConditions[chan].wait()
         del self.joinConditions[chan]
         self.pout((("Joined channel ", gui.cyanText), ("#" + chan, gui.yellowText), ("#" + chan, gui.yellowText), (".\n", None)))
@@ -589,20 +2763,23 @@ class IRCConnection:
         return ppt
 
     def printAndLogInfo(self, string):
-        """Acquires the print lock then both logs the info and prints it"""
-        s = string.encode(encoding, "replace").decode(encoding, "replace")
-        logging.info(s)
-        self.printInfo(s)
+        """Both logs the info and prints it"""
+        logging.info(string)
+        self.lockPrint(string)
 
     def lockPrint(self, string):
-        """Acquires the print lock then prints the string"""
+        """Prints the string, replacing what the terminal can't show"""
         s = string.encode(encoding, "replace").decode(encoding, "replace")
         self.printInfo(s)
 
     def logInfo(self, string):
-        """Acquires the print lock then logs the string"""
-        s = string.encode(encoding, "replace").decode(encoding, "replace")
-        logging.info(s)
+        """Logs the string. The log file is UTF-8 so it needs no cleaning up"""
+        logging.info(string)
+
+    def trace(self, fmt, *args):
+        """Wire-level logging. fmt % args is only formatted when TRACE is enabled"""
+        if logging.root.isEnabledFor(TRACE):
+            logging.log(TRACE, fmt, *args)
 
     def printInfo(self, string):
         if self.gui is None:
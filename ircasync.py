@@ -0,0 +1,200 @@
+"""
+An asyncio engine for irc.py.
+The irc socket, message dispatch and DCC transfers all run
+as coroutines on a single event loop thread.
+Needs python 3.7 or newer, irc.py only imports it on request.
+"""
+
+import asyncio
+import socket
+import logging
+from threading import Thread
+from time import monotonic
+
+import irc
+
+
+class AsyncioEngine(Thread):
+    """
+    An AsyncioEngine owns the event loop of an IRCConnection.
+    Other threads talk to it through listen/wake, which are
+    safe to call from anywhere.
+    """
+    def __init__(self, ircConnection):
+        Thread.__init__(self)
+        self.ircCon = ircConnection
+        self.loop = asyncio.new_event_loop()
+        self.socket = None
+        self.wakeup = None
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.wakeup = asyncio.Event()
+        self.loop.create_task(self.writer())
+        self.loop.run_forever()
+
+    def listen(self, sock):
+        """Hands a freshly connected irc socket over to the event loop."""
+        self.loop.call_soon_threadsafe(self.attach, sock)
+
+    def wake(self):
+        """Tells the writer there are new lines in the OutboundQueue."""
+        self.loop.call_soon_threadsafe(self.notify)
+
+    def notify(self):
+        self.wakeup.set()
+
+    def startTransfer(self, dcc):
+        """Schedules a DCC transfer. Called from the event loop thread."""
+        self.loop.create_task(self.transfer(dcc))
+
+    def attach(self, sock):
+        if self.socket is not None and self.socket is not sock:
+            self.socket.close()
+        sock.setblocking(False)
+        self.socket = sock
+        self.loop.create_task(self.listener(sock))
+        self.wakeup.set()
+
+    async def writer(self):
+        """The coroutine equivalent of WriterThread.run."""
+        outbound = self.ircCon.outbound
+        while True:
+            # cleared before taking so a wake in between isn't lost
+            self.wakeup.clear()
+            data, wait = (b"", None) if self.socket is None else outbound.take(monotonic())
+            if data:
+                try:
+                    await self.loop.sock_sendall(self.socket, data)
+                except OSError as e:
+                    # the listener notices a dead connection and reconnects
+                    self.ircCon.printAndLogInfo("send error: {0}".format(e))
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def listener(self, sock):
+        """Main parse loop receives data and dispatches each line."""
+        framer = irc.LineFramer(self.ircCon.recvSize)
+        while sock is self.socket:
+            try:
+                new_data = await asyncio.wait_for(self.loop.sock_recv(sock, framer.recvSize), 300)
+            except asyncio.TimeoutError:
+                self.reconnect("Error: Socket timout. Reconnecting.")
+                return
+            except OSError as socketerror:
+                self.ircCon.lockPrint("Error: " + str(socketerror))
+                self.ircCon.lockPrint("Quitting listener.")
+                return
+            # recv returns 0 only when the connection is lost
+            if len(new_data) == 0:
+                self.reconnect("Error: Connection to server lost. Reconnecting.")
+                return
+            for line in framer.feed(new_data):
+                msg = self.ircCon.handler.parse(line)
+                if msg is None:
+                    continue
+                try:
+                    self.ircCon.handler.handle(msg)
+                except Exception:
+                    logging.exception("Exception while handling \"%s\"", line)
+
+    def reconnect(self, msg):
+        self.ircCon.printAndLogInfo(msg)
+        self.ircCon.metrics.inc("irc_reconnects_total")
+        # connect() blocks until the listener sees the welcome message,
+        # so it must not run on the event loop itself. A daemon thread
+        # rather than the executor, so retrying doesn't keep python from exiting.
+        reconnecter = Thread(target = self.ircCon.connect, args = (3,))
+        reconnecter.daemon = True
+        reconnecter.start()
+
+    async def transfer(self, dcc):
+        try:
+            await self.receive(dcc)
+        except Exception:
+            self.ircCon.printAndLogInfo("Exception occurred during file writing.")
+        finally:
+            self.ircCon.transferFinished(dcc)
+
+    async def receive(self, dcc):
+        """The coroutine equivalent of DCCThread.run."""
+        # conflict resolution and resuming wait on replies from the bot
+        if not await self.loop.run_in_executor(None, dcc.openFile):
+            return
+        dcc.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dcc.socket.setblocking(False)
+        try:
+            await asyncio.wait_for(self.loop.sock_connect(dcc.socket, (dcc.host, dcc.port)), self.ircCon.dccTimeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            dcc.socket.close()
+            await self.loop.run_in_executor(None, dcc.closeFile)
+            dcc.connectFailed(e)
+            await asyncio.sleep(3)
+            return
+        if dcc.canSplice():
+            await self.splice(dcc)
+        else:
+            await self.recvLoop(dcc)
+        if dcc.hasher is not None or dcc.writer is not None:
+            # verifying may wait for the bot's XDCC INFO reply, the writer for the disk
+            await self.loop.run_in_executor(None, dcc.complete)
+        else:
+            dcc.complete()
+
+    async def recvLoop(self, dcc):
+        """The coroutine equivalent of DCCThread.receiveLoop."""
+        while dcc.bytesReceived != dcc.filesize:
+            view = dcc.receiveBuffer(False)
+            if view is None:
+                # the disk is behind, wait for a buffer without blocking the loop
+                view = await self.loop.run_in_executor(None, dcc.receiveBuffer)
+            try:
+                n = await asyncio.wait_for(self.loop.sock_recv_into(dcc.socket, view), self.ircCon.dccTimeout)
+            except (OSError, asyncio.TimeoutError) as socketerror:
+                dcc.recvError(socketerror)
+                return False
+            if not dcc.received(n):
+                break
+            if dcc.limiter is not None:
+                wait = dcc.limiter.reserve(n)
+                if wait > 0:
+                    dcc.limiterWait += wait
+                    await asyncio.sleep(wait)
+        return True
+
+    async def splice(self, dcc):
+        """The coroutine equivalent of DCCThread.spliceLoop."""
+        dcc.openPipe()
+        try:
+            while dcc.bytesReceived != dcc.filesize:
+                try:
+                    n = dcc.spliceChunk()
+                except BlockingIOError:
+                    try:
+                        await asyncio.wait_for(self.readable(dcc.socket), self.ircCon.dccTimeout)
+                    except asyncio.TimeoutError as socketerror:
+                        dcc.recvError(socketerror)
+                        return False
+                    continue
+                except OSError as socketerror:
+                    dcc.recvError(socketerror)
+                    return False
+                if n == 0:
+                    dcc.socketClosed()
+                    break
+        finally:
+            dcc.closePipe()
+        return True
+
+    async def readable(self, sock):
+        waiter = self.loop.create_future()
+        self.loop.add_reader(sock, waiter.set_result, None)
+        try:
+            await waiter
+        finally:
+            self.loop.remove_reader(sock)
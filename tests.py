@@ -1,10 +1,15 @@
 #!/usr/bin/python
 from irc import *
+from fakeirc import FakeIRCServer, FakeBot, FakePack
 from nose.tools import *
-from os import remove
+from os import remove, chdir, getcwd
+from shutil import rmtree
+from tempfile import mkdtemp
 from os.path import isfile
-from time import sleep
+from time import sleep, monotonic
 from random import randint
+from threading import active_count
+from contextlib import contextmanager
 
 def test_cs():
     assert(convertSize(0) == "0 B")
@@ -17,12 +22,334 @@ def test_cs():
         assert(tmp == ("1.%i TiB" % x))
     assert_raises(ValueError, convertSize, -1)
 
+def test_parse_message():
+    msg = parseMessage(":bot!~iroffer@host PRIVMSG nick :\x01DCC SEND \"a b.mkv\" 2130706433 5000 12\x01")
+    assert(msg.nickname == "bot" and msg.user == "~iroffer" and msg.host == "host")
+    assert(msg.command == "PRIVMSG" and msg.params == "nick")
+    assert(parseDCCSend(msg.trailing) == ("a b.mkv", 2130706433, 5000, 12))
+    msg = parseMessage("PING irc.example.net")
+    assert(msg.prefix is None and msg.command == "PING" and msg.trailing == "irc.example.net")
+    msg = parseMessage(":irc.example.net 353 nick = #chan :a b c")
+    assert(msg.params == "nick = #chan" and msg.trailing == "a b c")
+    assert(parseMessage(":prefix-only") is None)
+
+def test_line_framer():
+    framer = LineFramer()
+    assert(framer.feed(b"PING :a\r\n:n!u@h PRIVMSG me :caf\xc3") == ["PING :a"])
+    assert(framer.feed(b"\xa9\r\n\r\nPING :b\nPI") == [":n!u@h PRIVMSG me :caf\u00e9", "PING :b"])
+    assert(framer.feed(b"NG :c\r") == [] and framer.feed(b"\n") == ["PING :c"])
+
+class StubConnection:
+    """Just enough of an IRCConnection to make a DCCThread."""
+    gui = None
+    chunkSize = 256 * 1024
+
+    def __init__(self):
+        self.metrics = Metrics()
+
+    def limiterFor(self, bot):
+        return None
+
+def test_progress_reporter():
+    assert(convertTime(9.5) == "9s" and convertTime(192) == "3m12s" and convertTime(3900) == "1h05m")
+    reporter = ProgressReporter(None, smoothing = 1.0)
+    dcc = DCCThread("a.mkv", None, None, 10 * 1024**2, StubConnection(), "bot")
+    assert(reporter.render(reporter.sample(0)) is None)
+    reporter.add(dcc)
+    dcc.bytesReceived = 1024**2
+    reporter.sample(0)
+    dcc.bytesReceived = 2 * 1024**2
+    assert(reporter.sample(1)[0][2] == 1024**2)
+    dcc.bytesReceived = 5 * 1024**2
+    assert(1024**2 < reporter.sample(2)[0][2] < 3 * 1024**2)
+    assert(reporter.render(reporter.sample(2)) == "a.mkv 2.3 MiB/s [5.0 MiB/10 MiB] ETA 2s")
+    reporter.remove(dcc)
+    assert(reporter.sample(3) == [])
+
+def test_pack_size():
+    assert(packSizeBytes("350M") == 349 * 1024**2)
+    assert(packSizeBytes("1.2G") == int(1.1 * 1024**3))
+    assert(packSizeBytes(" 24K") == 23 * 1024)
+    assert(packSizeBytes("<1K") == 0)
+
+@timed(5)
+def test_rate_limiter():
+    transfer = RateLimiter(0, RateLimiter(100))
+    start = monotonic()
+    for x in range(10):
+        transfer.consume(20 * 1024)
+    assert(1.9 < monotonic() - start < 2.5)
+    assert(RateLimiter(0).reserve(10**9) == 0)
+
+def test_bandwidth_schedule():
+    assert(BandwidthSchedule({0: 50})() == 50)
+    assert(BandwidthSchedule({0: 50, 12: 100})() in (50, 100))
+
+def test_watchlist():
+    w = Watchlist([r"\[Grp\] Show.*\[720p\]", r"(a)\1", r"(?i)foo", r"[invalid"])
+    assert(len(w.patterns) == 3)
+    records = [parsePackLine(l) for l in ("#1  5x [350M] [Grp] Show - 01 [720p].mkv", "#2  0x [1.2G] baad.mkv", "#3 1x [<1K] FOO.txt")]
+    assert(records[0].pack == "#1" and records[0].dls == 5 and records[0].size == "350M")
+    assert([(r.pack, i) for r, i in w.matches(records)] == [("#1", 0), ("#2", 1), ("#3", 2)])
+    assert(parsePackLine("** 3 packs **") is None)
+
+def test_packlist_snapshot():
+    snapshot = PacklistSnapshot()
+    first = [parsePackLine(l) for l in ("#1 0x [1M] a.mkv", "#2 0x [1M] b.mkv", "#3 0x [1M] c.mkv")]
+    new, removed, changed = snapshot.diff(first, ["a"])
+    assert(len(new) == 3 and not removed and not changed)
+    second = [parsePackLine(l) for l in ("#1 0x [1M] a.mkv", "#2 0x [1M] c.mkv", "#3 0x [2M] d.mkv")]
+    new, removed, changed = snapshot.diff(second, ["a"])
+    assert([r.name for r in new] == ["d.mkv"])
+    assert([r.name for r in removed] == ["b.mkv"])
+    assert([r.name for r in changed] == ["c.mkv"])
+    snapshot.forget("a.mkv")
+    assert([r.name for r in snapshot.diff(second, ["a"])[0]] == ["a.mkv"])
+    assert(len(snapshot.diff(second, ["b"])[0]) == 3)
+
+def test_packlist_receiver():
+    receiver = PacklistReceiver()
+    receiver.write(b"** 2 packs **\n#1  3x [1M] a.m")
+    receiver.write(memoryview(b"kv\n#2  0x [2M] b.mkv"))
+    receiver.close(True)
+    assert([(r.pack, r.name) for r in receiver] == [("#1", "a.mkv"), ("#2", "b.mkv")])
+    assert(receiver.complete and receiver.received == 49)
+
+def test_outbound_queue():
+    queue = OutboundQueue(burst = 2, interval = 1.0)
+    queue.put(b"PRIVMSG bot :XDCC SEND #1\r\n")
+    queue.put(b"PRIVMSG bot :XDCC SEND #2\r\n")
+    queue.put(b"JOIN #chan\r\n")
+    queue.put(b"NICK me\r\n")
+    now = queue.last
+    # only registration goes out before the welcome
+    assert(queue.take(now) == (b"NICK me\r\n", None))
+    queue.registered()
+    assert(queue.take(now) == (b"JOIN #chan\r\nPRIVMSG bot :XDCC SEND #1\r\n", 1.0))
+    queue.put(b"PONG :irc.example.net\r\n")
+    assert(queue.take(now + 0.5) == (b"PONG :irc.example.net\r\n", 0.5))
+    assert(queue.take(now + 1.0) == (b"PRIVMSG bot :XDCC SEND #2\r\n", None))
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.inc("irc_lines_received_total", command = "PING")
+    metrics.inc("irc_lines_received_total", 2, command = "PING")
+    metrics.add("xdcc_active_transfers", 1)
+    metrics.observe("xdcc_transfer_seconds", 5, TRANSFER_BUCKETS)
+    metrics.collect(lambda m: m.set("irc_send_queue_depth", 4))
+    snapshot = metrics.snapshot()
+    assert(snapshot['irc_lines_received_total{command="PING"}'] == 3)
+    assert(snapshot["irc_send_queue_depth"] == 4 and snapshot["xdcc_active_transfers"] == 1)
+    assert(snapshot["xdcc_transfer_seconds"]["buckets"][1] == 0 and snapshot["xdcc_transfer_seconds"]["buckets"][10] == 1)
+    text = metrics.exposition()
+    assert('irc_lines_received_total{command="PING"} 3.0' in text)
+    assert('xdcc_transfer_seconds_bucket{le="+Inf"} 1' in text)
+
+def test_stream_hash():
+    hasher = StreamHash()
+    hasher.update(b"hello ")
+    hasher.update(memoryview(b"world"))
+    assert(hasher.crc32sum() == "0D4A1185")
+    assert(hasher.md5sum() == "5eb63bbbe01eeed093cb22bb8f5acdc3")
+    with open("hashtest.txt", "wb") as f:
+        f.write(b"hello world")
+    assert(hashFile("hashtest.txt", 5, chunkSize = 2).md5sum() == "5d41402abc4b2a76b9719d911017c592")
+    remove("hashtest.txt")
+
+def test_file_catalog():
+    with open("catalogtest.mkv", "wb") as f:
+        f.write(b"hello world")
+    catalog = FileCatalog("catalogtest.db")
+    assert(catalog.size("catalogtest.mkv") == 11)
+    assert(catalog.claim("catalogtest.mkv") and not catalog.claim("catalogtest.mkv"))
+    catalog.release("catalogtest.mkv")
+    assert(catalog.claim("catalogtest.mkv"))
+    assert(catalog.md5("catalogtest.mkv") == "5eb63bbbe01eeed093cb22bb8f5acdc3")
+    catalog.update("catalogtest.mkv", 11, 20)
+    assert(FileCatalog("catalogtest.db").get("catalogtest.mkv").state == FileCatalog.PARTIAL)
+    # preallocated by a transfer that died, cut back to what it recorded
+    with open("catalogtest.mkv", "ab") as f:
+        f.truncate(20)
+    assert(FileCatalog("catalogtest.db").size("catalogtest.mkv") == 11 and getsize("catalogtest.mkv") == 11)
+    remove("catalogtest.mkv")
+    catalog.sync()
+    assert(catalog.get("catalogtest.mkv") is None)
+    remove("catalogtest.db")
+
+def test_pack_index():
+    index = PackIndex()
+    index.add("A", parsePackLine("#4 0x [350M] a.mkv"))
+    index.add("B", parsePackLine("#9 0x [350M] a.mkv"))
+    index.add("C", parsePackLine("#2 0x [700M] a.mkv"))
+    assert(index.sources(parsePackLine("#1 0x [350M] a.mkv")) == {"A": "#4", "B": "#9"})
+    index.remove("A", parsePackLine("#4 0x [350M] a.mkv"))
+    assert(index.sources(parsePackLine("#1 0x [350M] a.mkv")) == {"B": "#9"})
+    stats = BotStats("botstatstest.db")
+    stats.record("A", True, 1024**2, 5)
+    stats.record("B", True, 10 * 1024**2, 5)
+    stats.record("B", False)
+    assert(BotStats("botstatstest.db").rate("B") == 10 * 1024**2)
+    assert(stats.expected("B", 1024**3) < stats.expected("A", 1024**3))
+    # never tried, as fast as the best
+    assert(stats.expected("C", 1024**3) < stats.expected("B", 1024**3))
+    remove("botstatstest.db")
+    assert(packRanges(["#7", "#2", "#3", "#4"]) == "2-4,7")
+
+def test_bench_regressions():
+    from bench import compareResults
+    baseline = {"parse_message": 100.0, "convert_size": 50.0}
+    results = {"parse_message": 130.0, "convert_size": 55.0, "line_framer": 1000.0}
+    assert(compareResults(results, baseline, 0.25) == ["parse_message"])
+    assert(compareResults(results, baseline, 0.5) == [])
+    # everything slower on a busy machine isn't a regression
+    baseline["calibration"], results["calibration"] = 100.0, 150.0
+    assert(compareResults(results, baseline, 0.25) == [])
+
+@contextmanager
+def fakeNetwork(*bots):
+    """A running FakeIRCServer with bots, and an empty directory to download into."""
+    server = FakeIRCServer()
+    for bot in bots:
+        server.addBot(bot)
+    server.start()
+    home = getcwd()
+    chdir(mkdtemp())
+    try:
+        yield server
+    finally:
+        rmtree(getcwd())
+        chdir(home)
+        server.stop()
+
+@timed(30)
+def test_fake_download(engine = "thread"):
+    bot = FakeBot("Bot", [FakePack("[Grp] Show - 01 [720p].mkv", 3 * 1024**2), FakePack("notes.txt", 5000)], dropAfter = 1024**2)
+    with fakeNetwork(bot) as server:
+        con = IRCConnection(server.address(), "testroughneck", verify = True, engine = engine)
+        con.parseBot("Bot", [r"Show - 01", r"notes"])
+        for pack in bot.packs:
+            with open(pack.name, "rb") as f:
+                assert(f.read() == pack.contents())
+            assert(con.catalog.get(pack.name).state == FileCatalog.VERIFIED)
+
+def test_fake_download_asyncio():
+    test_fake_download("asyncio")
+
+@timed(30)
+def test_fake_splice_asyncio():
+    bot = FakeBot("Bot", [FakePack("a.mkv", 3 * 1024**2)], dropAfter = 1024**2)
+    with fakeNetwork(bot) as server:
+        # spliced where os.splice exists, received into buffers elsewhere
+        con = IRCConnection(server.address(), "testroughneck", zeroCopy = True, engine = "asyncio")
+        con.parseBot("Bot", [r"a\.mkv"])
+        with open("a.mkv", "rb") as f:
+            assert(f.read() == bot.packs[0].contents())
+
+@timed(30)
+def test_fake_stall():
+    bot = FakeBot("Bot", [FakePack("a.mkv", 3 * 1024**2)], stallAfter = 1024**2)
+    with fakeNetwork(bot) as server:
+        con = IRCConnection(server.address(), "testroughneck", stallTime = 2, progressInterval = 0.5)
+        con.parseBot("Bot", [r"a\.mkv"])
+        with open("a.mkv", "rb") as f:
+            assert(f.read() == bot.packs[0].contents())
+        assert(con.metrics.snapshot()['xdcc_stalls_total{bot="Bot"}'] == 1)
+
+@timed(30)
+def test_fake_sources():
+    pack = FakePack("a.mkv", 2 * 1024**2)
+    slow = FakeBot("Slow", [pack], rate = 1024)
+    fast = FakeBot("Fast", [FakePack("b.mkv", 1024), pack], dropAfter = 1024**2)
+    with fakeNetwork(slow, fast) as server:
+        con = IRCConnection(server.address(), "testroughneck")
+        con.botStats.record("Slow", True, 100 * 1024, 0)
+        con.parseBot("Fast", [r"nothing"])
+        # found on Slow, asked of Fast first, finished by Slow once Fast drops it
+        con.parseBot("Slow", [r"a\.mkv"])
+        with open("a.mkv", "rb") as f:
+            assert(f.read() == pack.contents())
+        snapshot = con.metrics.snapshot()
+        assert(snapshot['xdcc_received_bytes_total{bot="Fast"}'] >= 1024**2)
+        assert(snapshot['xdcc_received_bytes_total{bot="Slow"}'] < 2 * 1024**2)
+
+@timed(30)
+def test_fake_poll_busy():
+    pack = FakePack("a.mkv", 2 * 1024**2)
+    fast = FakeBot("Fast", [pack], rate = 1024)
+    with fakeNetwork(FakeBot("Slow", [pack], rate = 256), fast) as server:
+        con = IRCConnection(server.address(), "testroughneck")
+        con.botStats.record("Slow", True, 256 * 1024, 0)
+        con.botStats.record("Fast", True, 1024**2, 0)
+        con.parseBot("Fast", [r"nothing"])
+        # found on Slow, coming from Fast while Fast is polled again
+        parser = con.parseBot("Slow", [r"a\.mkv"], blocking = False)
+        while not con.scheduler.busy("Fast"):
+            sleep(0.05)
+        con.parseBot("Fast", [r"nothing"])
+        parser.join()
+        with open("a.mkv", "rb") as f:
+            assert(f.read() == pack.contents())
+        # only the first poll, when nothing was coming from Fast
+        assert(fast.cancels == 1)
+
+@timed(30)
+def test_fake_queue(engine = "thread"):
+    b = FakePack("b.mkv", 1024**2)
+    busy = FakeBot("Busy", [FakePack("a.mkv", 3 * 1024**2), b], rate = 256, slots = 1)
+    with fakeNetwork(busy, FakeBot("Free", [b])) as server:
+        con = IRCConnection(server.address(), "testroughneck", botTransfers = 2, queueInterval = 1, engine = engine)
+        con.botStats.record("Busy", True, 4 * 1024**2, 0)
+        con.botStats.record("Free", True, 200 * 1024, 0)
+        con.parseBot("Free", [r"nothing"])
+        # both go to Busy, b waits in its queue until Free looks quicker
+        con.parseBot("Busy", [r"mkv"])
+        with open("b.mkv", "rb") as f:
+            assert(f.read() == b.contents())
+        assert(busy.removed == 1)
+        assert(con.metrics.snapshot()['xdcc_received_bytes_total{bot="Free"}'] >= 1024**2)
+
+def test_fake_queue_asyncio():
+    test_fake_queue("asyncio")
+
+@timed(60)
+def test_fake_batch(engine = "thread"):
+    packs = [FakePack("%s.mkv" % name, 512 * 1024) for name in "abc"]
+    new = FakeBot("New", packs, rate = 1024, slots = 2)
+    old = FakeBot("Old", [FakePack("%s.avi" % name, 256 * 1024) for name in "abc"], batch = False)
+    with fakeNetwork(new, old) as server:
+        con = IRCConnection(server.address(), "testroughneck", queueInterval = 1, engine = engine, pipeline = 1, batch = True)
+        con.scheduler.batchTimeout = 2
+        # a and b in one batch, c once one of them is through
+        con.parseBot("New", [r"mkv"])
+        for pack in packs:
+            with open(pack.name, "rb") as f:
+                assert(f.read() == pack.contents())
+        assert(new.batches == 1)
+        # the batch goes unanswered, so the packs are asked for one by one
+        con.parseBot("Old", [r"avi"])
+        assert(all(isfile(name + ".avi") for name in "abc"))
+        assert(con.scheduler.batchSupport == {"New": True, "Old": False})
+
+def test_fake_batch_asyncio():
+    test_fake_batch("asyncio")
+
 @timed(15)
 def test_connect_strings():
     IRCConnection("irc.rizon.net", "testroughneck" + str(randint(1000, 9999)))
     sleep(1)
     IRCConnection("irc.rizon.net:6667", "testroughneck"+ str(randint(1000, 9999)))
 
+@timed(15)
+def test_connect_asyncio():
+    con = IRCConnection("irc.rizon.net:6667", "testroughneck" + str(randint(1000, 9999)), engine = "asyncio")
+    assert(con.engine is not None)
+
+def test_unknown_engine():
+    threads = active_count()
+    assert_raises(ValueError, IRCConnection, "irc.rizon.net", "testroughneck", engine = "fibers")
+    # refused before any thread was started
+    assert(active_count() == threads)
+
 @timed(45)
 def test_packlist():
     if isfile('xdcc.txt'):